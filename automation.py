@@ -0,0 +1,389 @@
+"""
+Envelope breakpoints and block evaluation
+
+An Envelope is a sorted set of (time, value) breakpoints, value 0 - 127 like
+envelope_editor.steps, interpolated linearly and held flat before the first
+and after the last point. Evaluation works a block at a time: the block is
+split where it crosses breakpoints (found with bisect) and each piece is a
+single arithmetic progression, so the per-sample work is one multiply-add in
+a list comprehension. The segment of the last position evaluated is cached,
+which makes consecutive blocks O(1) to locate.
+
+Each breakpoint also has the shape of the segment leaving it: linear,
+exponential, S-curve, step (jump to the next value) or hold (keep this one
+until the next point). Curved segments are read from lookup tables shared by
+every segment, so they cost one table read per sample instead of the
+multiply-add of a straight one.
+
+A Recorder turns dense recorded automation into a small set of breakpoints
+as the samples arrive, and lfo() writes a periodic pattern as breakpoints.
+"""
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+
+LINEAR, EXPONENTIAL, S_CURVE, STEP, HOLD = range(5)
+SHAPE_NAMES = ('linear', 'exponential', 's-curve', 'step', 'hold')
+SHAPE_SIZE = 1024 # table entries per segment
+OUTLINE_SIZE = 16 # lines per curved segment when drawn
+
+def shape_table(function):
+    return array('d', [function(i / float(SHAPE_SIZE)) for i in range(SHAPE_SIZE + 1)])
+
+## fraction of the way to the next value, by fraction of the way in time
+SHAPE_TABLES = {
+    EXPONENTIAL: shape_table(lambda x: (math.exp(4. * x) - 1.) / (math.exp(4.) - 1.)),
+    S_CURVE: shape_table(lambda x: (1. - math.cos(math.pi * x)) / 2.),
+}
+
+## (time, value) fractions to draw a segment through, after its first point
+SHAPE_OUTLINES = {
+    LINEAR: ((1., 1.),),
+    STEP: ((0., 1.), (1., 1.)),
+    HOLD: ((1., 0.), (1., 1.)),
+}
+for shape, table in SHAPE_TABLES.items():
+    SHAPE_OUTLINES[shape] = tuple((i / float(OUTLINE_SIZE), table[i * SHAPE_SIZE // OUTLINE_SIZE])
+            for i in range(1, OUTLINE_SIZE + 1))
+
+class Envelope(object):
+    '''sorted breakpoints with block evaluation'''
+    def __init__(self, times=(), values=(), shapes=None):
+        self.times = array('d')
+        self.values = array('d')
+        self.shapes = array('B') # shape of the segment leaving each breakpoint
+        self.segment = -1 # cached index of the breakpoint left of the last position
+        self.set_points(times, values, shapes)
+
+    def __len__(self):
+        return len(self.times)
+
+    def set_points(self, times, values, shapes=None):
+        """replaces every breakpoint, sorting them by time"""
+        if shapes is None:
+            shapes = [LINEAR] * len(times)
+        points = sorted(zip(times, values, shapes), key=lambda point: point[0])
+        self.times = array('d', [point[0] for point in points])
+        self.values = array('d', [point[1] for point in points])
+        self.shapes = array('B', [point[2] for point in points])
+        self.segment = -1
+
+    def insert(self, time, value, shape=LINEAR, hi=None):
+        """adds a breakpoint after any at the same time (but not after index
+        hi, like bisect), returns its index"""
+        index = bisect_right(self.times, time, 0, len(self.times) if hi is None else hi)
+        self.times.insert(index, time)
+        self.values.insert(index, value)
+        self.shapes.insert(index, shape)
+        self.segment = -1
+        return index
+
+    def set_point(self, index, time, value):
+        """moves a breakpoint, the caller keeps it between its neighbours"""
+        self.times[index] = time
+        self.values[index] = value
+        self.segment = -1
+
+    def set_shapes(self, indices, shape):
+        """sets the shape of the segments leaving some breakpoints"""
+        for index in indices:
+            self.shapes[index] = shape
+
+    def set_many(self, indices, times, values):
+        """moves several breakpoints at once and sorts them back into place,
+        returns the new indices of the moved ones"""
+        indices = list(indices)
+        for index, time, value in zip(indices, times, values):
+            self.times[index] = time
+            self.values[index] = value
+        self.segment = -1
+        order = sorted(range(len(self.times)), key=self.times.__getitem__)
+        if any(order[i] != i for i in range(len(order))):
+            self.times = array('d', [self.times[i] for i in order])
+            self.values = array('d', [self.values[i] for i in order])
+            self.shapes = array('B', [self.shapes[i] for i in order])
+        position = dict((old, new) for new, old in enumerate(order))
+        return [position[index] for index in indices]
+
+    def remove_many(self, indices):
+        doomed = set(indices)
+        keep = [i for i in range(len(self.times)) if i not in doomed]
+        self.times = array('d', [self.times[i] for i in keep])
+        self.values = array('d', [self.values[i] for i in keep])
+        self.shapes = array('B', [self.shapes[i] for i in keep])
+        self.segment = -1
+
+    def span(self, start, end):
+        """indices [first, last) of the breakpoints with start <= time <= end"""
+        return bisect_left(self.times, start), bisect_right(self.times, end)
+
+    def drawn_points(self, first, last):
+        """(times, values) of the polyline through breakpoints first..last - 1,
+        with the curved, step and hold segments between them traced out"""
+        times = self.times
+        values = self.values
+        shapes = self.shapes
+        out_times = array('d')
+        out_values = array('d')
+        for i in range(first, last):
+            if i == first:
+                out_times.append(times[i])
+                out_values.append(values[i])
+            if i + 1 >= last:
+                break
+            t0 = times[i]
+            v0 = values[i]
+            span = times[i + 1] - t0
+            change = values[i + 1] - v0
+            for time, value in SHAPE_OUTLINES[shapes[i]]:
+                out_times.append(t0 + time * span)
+                out_values.append(v0 + value * change)
+        return out_times, out_values
+
+    # -------------------------------------------------------------------------
+    # Evaluation
+
+    def find(self, position):
+        """index of the last breakpoint at or before a position, -1 if none"""
+        times = self.times
+        segment = self.segment
+        last = len(times) - 1
+        for candidate in (segment, segment + 1):
+            if -1 <= candidate <= last \
+                    and (candidate < 0 or times[candidate] <= position) \
+                    and (candidate == last or position < times[candidate + 1]):
+                self.segment = candidate
+                return candidate
+        self.segment = bisect_right(times, position) - 1
+        return self.segment
+
+    def line(self, segment):
+        """(time, value, slope) of the piece starting at a breakpoint index;
+        slope is None for curved pieces, see curve()"""
+        times = self.times
+        values = self.values
+        if segment < 0:
+            return 0., values[0], 0.
+        if segment >= len(times) - 1:
+            return times[segment], values[segment], 0.
+        t0 = times[segment]
+        v0 = values[segment]
+        shape = self.shapes[segment]
+        if shape == HOLD:
+            return t0, v0, 0.
+        if shape == STEP:
+            return t0, values[segment + 1], 0.
+        if shape != LINEAR:
+            return t0, v0, None
+        return t0, v0, (values[segment + 1] - v0) / (times[segment + 1] - t0)
+
+    def curve(self, segment, offsets):
+        """values of a curved piece at offsets (position - its start time)"""
+        t0 = self.times[segment]
+        v0 = self.values[segment]
+        change = self.values[segment + 1] - v0
+        scale = SHAPE_SIZE / (self.times[segment + 1] - t0)
+        table = SHAPE_TABLES[self.shapes[segment]]
+        return array('d', [v0 + change * table[int(offset * scale + .5)] for offset in offsets])
+
+    def value_at(self, position):
+        if not self.times:
+            return 0.
+        segment = self.find(position)
+        t0, v0, slope = self.line(segment)
+        if slope is None:
+            return self.curve(segment, [position - t0])[0]
+        return v0 + (position - t0) * slope
+
+    def render(self, start, step, count, loop_length=None):
+        """values at start, start + step, ... (count of them), e.g. one audio
+        block with step = beats per sample; positions wrap at loop_length"""
+        out = array('d')
+        if not self.times:
+            out.extend(array('d', [0.]) * count)
+            return out
+        if not loop_length:
+            self.render_span(out, start, step, count)
+            return out
+        start %= loop_length
+        done = 0
+        while done < count:
+            ## samples left before the loop end
+            span = min(count - done, max(1, int(-(-(loop_length - start) // step))))
+            self.render_span(out, start, step, span)
+            done += span
+            start = (start + span * step) % loop_length
+        return out
+
+    def render_span(self, out, start, step, count):
+        times = self.times
+        last = len(times) - 1
+        i = 0
+        segment = self.find(start)
+        while i < count:
+            t0, v0, slope = self.line(segment)
+            if segment >= last:
+                j = count
+            else:
+                ## first sample at or past the next breakpoint
+                j = min(count, max(i + 1, int(-(-(times[segment + 1] - start) // step))))
+            if slope is None:
+                offset = start - t0
+                out.extend(self.curve(segment, [offset + step * k for k in range(i, j)]))
+            elif slope:
+                a = v0 + (start - t0) * slope
+                b = step * slope
+                out.extend(array('d', [a + b * k for k in range(i, j)]))
+            else:
+                out.extend(array('d', [v0]) * (j - i))
+            i = j
+            if i < count:
+                segment = self.find(start + i * step)
+
+    def evaluate(self, positions):
+        """values at arbitrary ascending positions (ticks, beats, ...)"""
+        out = array('d')
+        count = len(positions)
+        if not self.times:
+            out.extend(array('d', [0.]) * count)
+            return out
+        times = self.times
+        last = len(times) - 1
+        i = 0
+        while i < count:
+            segment = self.find(positions[i])
+            t0, v0, slope = self.line(segment)
+            j = count if segment >= last else bisect_left(positions, times[segment + 1], i)
+            j = max(j, i + 1)
+            if slope is None:
+                out.extend(self.curve(segment, [positions[k] - t0 for k in range(i, j)]))
+            elif slope:
+                a = v0 - t0 * slope
+                out.extend(array('d', [a + slope * positions[k] for k in range(i, j)]))
+            else:
+                out.extend(array('d', [v0]) * (j - i))
+            i = j
+        return out
+
+def outline(times, values, bucket):
+    """decimates breakpoints for drawing: of the points falling in each
+    bucket-wide time slice only the first, lowest, highest and last are
+    kept, which keeps the drawn shape at one slice per pixel; returns
+    (times, values) arrays"""
+    keep = []
+    count = len(times)
+    i = 0
+    while i < count:
+        slice_end = (int(times[i] // bucket) + 1) * bucket
+        j = max(i + 1, bisect_left(times, slice_end, i)) # float rounding can put times[i] at slice_end
+        lowest = highest = i
+        for k in range(i + 1, j):
+            if values[k] < values[lowest]:
+                lowest = k
+            elif values[k] > values[highest]:
+                highest = k
+        keep.extend(sorted(set((i, lowest, highest, j - 1))))
+        i = j
+    return array('d', [times[k] for k in keep]), array('d', [values[k] for k in keep])
+
+class Recorder(object):
+    '''reduces a dense stream of (time, value) samples to breakpoints on the fly
+
+    Uses a swinging door: the kept line may pivot anywhere inside the cone of
+    slopes that keeps every sample since the last breakpoint within
+    tolerance. When a sample closes the cone a breakpoint is emitted on the
+    middle of the cone at the previous sample, so every recorded sample stays
+    within tolerance of the decimated curve. Work and memory per sample are
+    constant.
+    '''
+    def __init__(self, tolerance=0.5):
+        self.tolerance = tolerance
+        self.times = array('d') # the decimated breakpoints
+        self.values = array('d')
+        self.samples = 0
+        self.anchor = None # (time, value) of the last breakpoint
+        self.last = None # the previous sample
+        self.lower = self.upper = 0.
+
+    def add(self, time, value):
+        self.samples += 1
+        value = max(0., min(127., value))
+        if self.anchor is None:
+            self.emit(time, value)
+            return
+        anchor_time, anchor_value = self.anchor
+        span = time - anchor_time
+        if span <= 0:
+            return
+        tolerance = self.tolerance
+        upper = (value + tolerance - anchor_value) / span
+        lower = (value - tolerance - anchor_value) / span
+        if self.last is not None:
+            upper = min(upper, self.upper)
+            lower = max(lower, self.lower)
+            if lower > upper:
+                ## this sample doesn't fit, end the line at the previous one
+                last_time = self.last[0]
+                slope = (self.lower + self.upper) / 2.
+                self.emit(last_time, anchor_value + slope * (last_time - anchor_time))
+                self.add(time, value)
+                self.samples -= 1
+                return
+        self.lower, self.upper = lower, upper
+        self.last = (time, value)
+
+    def add_many(self, times, values):
+        add = self.add
+        for time, value in zip(times, values):
+            add(time, value)
+
+    def emit(self, time, value):
+        self.times.append(time)
+        self.values.append(value)
+        self.anchor = (time, value)
+        self.last = None
+
+    def finish(self):
+        """closes the last line at the last sample, returns (times, values)"""
+        if self.last is not None:
+            anchor_time, anchor_value = self.anchor
+            last_time = self.last[0]
+            slope = (self.lower + self.upper) / 2.
+            self.emit(last_time, anchor_value + slope * (last_time - anchor_time))
+        return self.times, self.values
+
+LFO_WAVES = ('saw', 'ramp', 'triangle', 'sine', 'square')
+
+def lfo(start, end, period, low, high, wave='saw'):
+    """breakpoints of a periodic pattern from start to end as (times, values,
+    shapes) arrays, two per period, ready for Envelope.set_points"""
+    times = array('d')
+    values = array('d')
+    shapes = array('B')
+    if wave == 'saw' or wave == 'ramp':
+        ## a ramp and a jump back, the jump is two points at the same time
+        first, second = (low, high) if wave == 'saw' else (high, low)
+        shape = LINEAR
+        half = period
+    elif wave == 'triangle' or wave == 'sine':
+        first, second = low, high
+        shape = LINEAR if wave == 'triangle' else S_CURVE
+        half = period / 2.
+    elif wave == 'square':
+        first, second = high, low
+        shape = HOLD
+        half = period / 2.
+    else:
+        raise ValueError('unknown wave: {}'.format(wave))
+    jump = half == period
+    cycles = int((end - start) / period + 1e-9)
+    for cycle in range(cycles):
+        time = start + cycle * period
+        times.extend((time, time + half))
+        values.extend((first, second))
+        shapes.extend((shape, shape))
+    if not jump or not cycles:
+        times.append(start + cycles * period)
+        values.append(first)
+        shapes.append(shape)
+    return times, values, shapes
@@ -0,0 +1,36 @@
+"""
+Times block evaluation of an envelope at audio rate over a long loop, with
+straight segments and with every segment shape mixed
+
+    python benchmarks/bench_envelope.py [points ...]
+"""
+import random
+
+from common import arg_counts, timer
+from automation import Envelope, SHAPE_NAMES
+
+SAMPLE_RATE = 48000
+BLOCK_SIZE = 256
+TEMPO = 120.
+LOOP_BEATS = 64.
+SECONDS = 60
+
+def main(counts):
+    step = TEMPO / 60. / SAMPLE_RATE # beats per sample
+    blocks = SECONDS * SAMPLE_RATE // BLOCK_SIZE
+    for count in counts:
+        rand = random.Random(count)
+        times = [i * LOOP_BEATS / count for i in range(count)]
+        values = [rand.uniform(0, 127) for i in times]
+        for label, shapes in (('linear', None),
+                ('mixed', [i % len(SHAPE_NAMES) for i in range(count)])):
+            envelope = Envelope(times, values, shapes)
+            start = timer()
+            for block in range(blocks):
+                envelope.render(block * BLOCK_SIZE * step, step, BLOCK_SIZE, LOOP_BEATS)
+            elapsed = timer() - start
+            print('{:>8} points, {:>6}: {} s of audio in {:.3f} s ({:.0f}x realtime, {:.1f} us/block)'.format(
+                count, label, SECONDS, elapsed, SECONDS / elapsed, 1e6 * elapsed / blocks))
+
+if __name__ == '__main__':
+    main(arg_counts([16, 1000, 100000]))
@@ -0,0 +1,31 @@
+"""
+Times compiling notes to an EventStream and querying it once per audio block
+
+    python benchmarks/bench_event_stream.py [count ...]
+"""
+from common import arg_counts, make_store, timer
+from events import EventStream
+from ticks import PPQ
+
+def main(counts, block=PPQ // 32):
+    for count in counts:
+        store = make_store(count)
+        loop = count * PPQ // 4
+        start = timer()
+        stream = EventStream(store, loop)
+        compiled = timer() - start
+        blocks = 10000
+        start = timer()
+        for i in range(blocks):
+            stream.query(i * block, (i + 1) * block)
+        query = (timer() - start) / blocks
+        note_ids = list(store)[::1000]
+        start = timer()
+        stream.update_many(note_ids)
+        update = timer() - start
+        print('{:>8} notes: compile {:7.1f} ms   query {:5.2f} us/block   '
+                'update {} notes {:6.2f} ms'.format(count, 1000 * compiled,
+                    1e6 * query, len(note_ids), 1000 * update))
+
+if __name__ == '__main__':
+    main(arg_counts([10000, 100000]))
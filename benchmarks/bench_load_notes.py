@@ -0,0 +1,45 @@
+"""
+Times bulk note loading into the piano roll
+
+The model part (NoteStore + NoteIndex) runs anywhere; PianoRoll.loadNotes is
+timed too when PyQt4 is available.
+
+    python benchmarks/bench_load_notes.py [count ...]
+"""
+import sys
+
+from common import arg_counts, make_notes, timer
+from note_store import NoteStore
+from note_index import NoteIndex
+from ticks import PPQ
+
+def bench_model(notes):
+    start = timer()
+    store = NoteStore()
+    store.add_many(*notes)
+    NoteIndex(store, bucket_length=PPQ)
+    return timer() - start
+
+def bench_scene(notes):
+    try:
+        from PyQt4 import QtGui
+    except ImportError:
+        return None
+    from piano_roll_editor import PianoRollView
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+    view = PianoRollView()
+    view.resize(1000, 600)
+    start = timer()
+    view.piano.loadNotes(*notes)
+    return timer() - start
+
+def main(counts):
+    for count in counts:
+        notes = make_notes(count)
+        model = bench_model(notes)
+        scene = bench_scene(notes)
+        print('{:>8} notes: store+index {:8.3f} s   PianoRoll.loadNotes {}'.format(
+            count, model, 'n/a (no PyQt4)' if scene is None else '{:.3f} s'.format(scene)))
+
+if __name__ == '__main__':
+    main(arg_counts([10000, 100000]))
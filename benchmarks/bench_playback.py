@@ -0,0 +1,58 @@
+"""
+Times rendering blocks of an EventStream ahead of the host, and checks that
+the events either side of every block boundary are played on their own frame
+
+    python benchmarks/bench_playback.py [count ...]
+"""
+from common import arg_counts, make_store, timer
+from events import EventStream
+from note_store import NoteStore
+from playback import PlaybackEngine
+from ticks import PPQ
+
+SETTINGS = ((48000, 256, 120.), (44100, 64, 93.7), (96000, 512, 171.))
+
+def check_block_boundaries(sample_rate, block_size, tempo, loop=4 * PPQ, spacing=5):
+    """plays one loop of one-tick notes, every spacing ticks, and compares the
+    frames the host reads them on with the frames of their ticks"""
+    store = NoteStore()
+    ticks = range(0, loop, spacing)
+    store.add_many([60] * len(ticks), ticks, [1] * len(ticks), [100] * len(ticks))
+    engine = PlaybackEngine(EventStream(store, loop), sample_rate, block_size, tempo,
+            capacity=1 << 16)
+    end = engine.tick_frame(loop)
+    expected = []
+    for tick in ticks:
+        expected.append((engine.tick_frame(tick), 0x90))
+        expected.append((engine.tick_frame(tick + 1), 0x80))
+    delivered = []
+    while engine.host_frame < end:
+        frame = engine.host_frame
+        engine.render_ahead()
+        delivered.extend((frame + offset, status) for offset, status, pitch, velocity
+                in engine.read_block())
+    expected = sorted(event for event in expected if event[0] < end)
+    delivered = sorted(event for event in delivered if event[0] < end)
+    if delivered != expected or engine.stats['late_events']:
+        raise AssertionError('events off their frames at {} Hz, {} frame blocks, {} bpm'.format(
+            sample_rate, block_size, tempo))
+    return len(delivered)
+
+def main(counts, blocks=10000):
+    for sample_rate, block_size, tempo in SETTINGS:
+        events = check_block_boundaries(sample_rate, block_size, tempo)
+        print('{} Hz, {} frame blocks, {} bpm: {} events on their frames'.format(
+            sample_rate, block_size, tempo, events))
+    for count in counts:
+        engine = PlaybackEngine(EventStream(make_store(count), count * PPQ // 4),
+                capacity=1 << 16)
+        start = timer()
+        for i in range(blocks):
+            engine.render_block()
+            engine.read_block()
+        elapsed = (timer() - start) / blocks
+        print('{:>8} notes: {:.1f} us per block ({:.0f}x realtime)'.format(
+            count, 1e6 * elapsed, engine.block_period() / elapsed))
+
+if __name__ == '__main__':
+    main(arg_counts([1000, 100000]))
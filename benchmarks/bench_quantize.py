@@ -0,0 +1,34 @@
+"""
+Times batch quantizing of a selection
+
+    python benchmarks/bench_quantize.py [count ...]
+"""
+import random
+
+from common import arg_counts, timer
+from quantize import quantize
+from ticks import PPQ, grid_ticks
+
+def make_columns(count):
+    """unquantized notes, roughly four per beat"""
+    rand = random.Random(count)
+    starts = [i * PPQ // 4 + rand.randint(-60, 60) + 60 for i in range(count)]
+    lengths = [rand.randint(PPQ // 8, PPQ) for i in range(count)]
+    return starts, lengths
+
+def bench(columns, grid, **options):
+    start = timer()
+    quantize(columns[0], columns[1], grid_ticks(grid), **options)
+    return timer() - start
+
+def main(counts):
+    for count in counts:
+        columns = make_columns(count)
+        print('{:>8} notes: 1/16 {:7.1f} ms   1/9 ends {:7.1f} ms   '
+                '1/16 swing+humanize 50% {:7.1f} ms'.format(count,
+            1000 * bench(columns, '1/16'),
+            1000 * bench(columns, '1/9', fix_ends=True),
+            1000 * bench(columns, '1/16', strength=.5, swing=.33, humanize=10, seed=1)))
+
+if __name__ == '__main__':
+    main(arg_counts([20000, 100000]))
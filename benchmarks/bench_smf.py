@@ -0,0 +1,55 @@
+"""
+Times .mid export and streaming import on a synthetic file, and import of
+a format 1 file with the same events split over several tracks
+
+    python benchmarks/bench_smf.py [events ...]
+"""
+import os
+import tempfile
+
+from common import arg_counts, make_store, timer
+from smf import CHUNK, HEADER, read_columns, write_notes
+from ticks import PPQ
+
+def write_tracks(path, stores):
+    """a format 1 file with one track per store, from write_notes' tracks"""
+    with open(path, 'wb') as out:
+        out.write(CHUNK.pack(b'MThd', HEADER.size) + HEADER.pack(1, len(stores), PPQ))
+        for store in stores:
+            write_notes(path + '.track', store)
+            with open(path + '.track', 'rb') as f:
+                data = f.read()
+            out.write(data[CHUNK.size + HEADER.size:])
+    os.remove(path + '.track')
+
+def main(counts, tracks=16):
+    fd, path = tempfile.mkstemp(suffix='.mid')
+    os.close(fd)
+    try:
+        for events in counts:
+            store = make_store(events // 2, PPQ // 8)
+            start = timer()
+            write_notes(path, store)
+            written = timer() - start
+            start = timer()
+            columns = read_columns(path)
+            read = timer() - start
+            print('{:>8} events ({:.1f} MB): export {:6.2f} s ({:.2f} M events/s)   '
+                    'import {:6.2f} s ({:.2f} M events/s)'.format(
+                events, os.path.getsize(path) / 1e6, written, events / written / 1e6,
+                read, events / read / 1e6))
+            assert len(columns[0]) == len(store)
+            stores = [make_store(events // 2 // tracks + i, PPQ // 8) for i in range(tracks)]
+            write_tracks(path, stores)
+            start = timer()
+            columns = read_columns(path)
+            read = timer() - start
+            print('{:>8} events in {} tracks ({:.1f} MB): import {:6.2f} s ({:.2f} M events/s)'.format(
+                2 * len(columns[0]), tracks, os.path.getsize(path) / 1e6, read,
+                2 * len(columns[0]) / read / 1e6))
+            assert len(columns[0]) == sum(len(store) for store in stores)
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    main(arg_counts([100000, 1000000]))
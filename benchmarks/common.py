@@ -0,0 +1,33 @@
+"""
+Setup shared by the bench_*.py scripts: puts the repository on the import
+path and builds the synthetic clips they time
+"""
+import os
+import random
+import sys
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from note_store import NoteStore
+from ticks import PPQ
+
+def make_notes(count, ticks_per_note=PPQ // 4):
+    """random notes as parallel columns, spread so the clip density stays
+    about constant"""
+    rand = random.Random(count)
+    pitches = [rand.randint(24, 96) for i in range(count)]
+    starts = [i * ticks_per_note for i in range(count)]
+    lengths = [rand.choice((ticks_per_note, 2 * ticks_per_note, PPQ)) for i in range(count)]
+    velocities = [rand.randint(20, 127) for i in range(count)]
+    return pitches, starts, lengths, velocities
+
+def make_store(count, ticks_per_note=PPQ // 4):
+    """a NoteStore holding make_notes(count, ticks_per_note)"""
+    store = NoteStore()
+    store.add_many(*make_notes(count, ticks_per_note))
+    return store
+
+def arg_counts(defaults):
+    """the sizes given on the command line, or defaults"""
+    return [int(arg) for arg in sys.argv[1:]] or defaults
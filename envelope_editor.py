@@ -2,82 +2,156 @@
 A piano roll viewer that will eventually become a piano roll editor
 """
 import sys
+from array import array
+from bisect import bisect_right
 from PyQt4 import QtGui, QtCore
-global_points = []
+from automation import Envelope, Recorder, outline, lfo, LFO_WAVES, \
+        LINEAR, EXPONENTIAL, S_CURVE, STEP, HOLD
 global_axes_size = 28
 #global_max_start_time = 999.0
 global_viewer_width = 1000
 global_viewer_height = 300
+lane_colors = [QtGui.QColor(50, 50, 200, 160),
+ QtGui.QColor(30, 140, 30, 160),
+ QtGui.QColor(200, 120, 0, 160),
+ QtGui.QColor(140, 40, 160, 160)]
 
-class envelope_item(QtGui.QGraphicsEllipseItem):
-    '''a single point on an envelope'''
-    def __init__(self, a_time, a_value):
-        f_size = 15
-        self.f_half_size = f_size / 2.0
-        QtGui.QGraphicsEllipseItem.__init__(self, 0, 0, f_size, f_size)
-        self.setFlag(QtGui.QGraphicsItem.ItemIsSelectable)
-        self.setFlag(QtGui.QGraphicsItem.ItemIsMovable)
-        self.setFlag(QtGui.QGraphicsItem.ItemSendsGeometryChanges)
-        self.setAcceptHoverEvents(True)
-        self.setPos(a_time - self.f_half_size, a_value - self.f_half_size)
-        self.setBrush(QtGui.QColor(255, 0, 0))
-        f_pen = QtGui.QPen()
-        f_pen.setWidth(2)
-        f_pen.setColor(QtGui.QColor(170, 0, 0))
-        self.setPen(f_pen)
+class lane_overlay(QtGui.QGraphicsItem):
+    '''the inactive lanes of an envelope editor, drawn behind the active one
+
+    Each lane is drawn from a path cached per zoom level, built from its
+    points decimated to about one time slice per pixel, and the item itself is
+    cached as a pixmap so editing the active lane never repaints these.
+    '''
+    def __init__(self, a_editor):
+        QtGui.QGraphicsItem.__init__(self)
+        self.editor = a_editor
+        self.setCacheMode(QtGui.QGraphicsItem.DeviceCoordinateCache)
+        self.setZValue(0.5)
+        self.paths = {} # (lane name, level) -> QPainterPath
+
+    def boundingRect(self):
+        return QtCore.QRectF(global_axes_size - 2, global_axes_size - 2,
+                global_viewer_width + 4, global_viewer_height + 4)
+
+    def lane_path(self, a_name, a_level):
+        f_path = self.paths.get((a_name, a_level))
+        if f_path is None:
+            f_editor = self.editor
+            f_envelope = f_editor.lane(a_name)
+            ## 2 ** a_level pixels per slice
+            f_times, f_values = f_envelope.drawn_points(0, len(f_envelope))
+            f_times, f_values = outline(f_times, f_values, 2.0 ** a_level / f_editor.beat_width)
+            f_path = QtGui.QPainterPath()
+            if f_times:
+                f_path.moveTo(f_editor.time_to_x(f_times[0]), f_editor.value_to_y(f_values[0]))
+                for f_time, f_value in zip(f_times, f_values):
+                    f_path.lineTo(f_editor.time_to_x(f_time), f_editor.value_to_y(f_value))
+            self.paths[(a_name, a_level)] = f_path
+        return f_path
+
+    def paint(self, a_painter, a_option, a_widget=None):
+        f_editor = self.editor
+        ## the view only scales horizontally, a slice of 2 ** level scene
+        ## pixels is about one on screen
+        f_scale = a_painter.worldTransform().m11()
+        f_level = 0
+        while f_scale * 2.0 ** f_level < 1.0:
+            f_level += 1
+        while f_scale * 2.0 ** f_level >= 2.0:
+            f_level -= 1
+        for i, f_name in enumerate(f_editor.lane_names):
+            if f_name == f_editor.lane_name:
+                continue
+            f_pen = QtGui.QPen(lane_colors[i % len(lane_colors)])
+            f_pen.setWidth(2)
+            a_painter.setPen(f_pen)
+            a_painter.drawPath(self.lane_path(f_name, f_level))
+
+    def invalidate(self, a_name = None):
+        """drops the cached paths of a lane, or of every lane"""
+        for f_key in list(self.paths):
+            if a_name is None or f_key[0] == a_name:
+                del self.paths[f_key]
+        self.update()
+
+class envelope_curve(QtGui.QGraphicsItem):
+    '''the lines and points of an envelope, painted from the editor's breakpoints
+
+    Only the segments inside the exposed rect are put in the painter path, so
+    a repaint after moving one point costs the same however long the
+    envelope is.
+    '''
+    def __init__(self, a_editor):
+        QtGui.QGraphicsItem.__init__(self)
+        self.editor = a_editor
+        self.setFlag(QtGui.QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.setZValue(1.)
+        self.f_size = 15
+        self.f_half_size = self.f_size / 2.0
+        self.line_pen = QtGui.QPen(QtGui.QColor(200, 50, 50))
+        self.line_pen.setWidth(4)
+        self.point_pen = QtGui.QPen(QtGui.QColor(170, 0, 0))
+        self.point_pen.setWidth(2)
         self.o_brush = QtGui.QColor(255, 0, 0)
         self.hover_brush = QtGui.QColor(255, 200, 200)
         self.s_brush = QtGui.QColor(0, 255, 0)
 
-        self.pressed = False
+    def boundingRect(self):
+        f_margin = self.f_half_size + 2
+        return QtCore.QRectF(global_axes_size - f_margin, global_axes_size - f_margin,
+                global_viewer_width + 2 * f_margin, global_viewer_height + 2 * f_margin)
 
-    def select(self):
-        self.setSelected(True)
-        self.setBrush(self.s_brush)
+    def visible_range(self, a_left, a_right):
+        """indices [first, last) of the points to paint for an x range, plus
+        one on each side so the lines leaving it are drawn too"""
+        f_editor = self.editor
+        f_first, f_last = f_editor.envelope.span(
+                f_editor.x_to_time(a_left - self.f_half_size),
+                f_editor.x_to_time(a_right + self.f_half_size))
+        return max(0, f_first - 1), min(len(f_editor.envelope), f_last + 1)
 
-    def deselect(self):
-        self.setSelected(False)
-        self.setBrush(self.o_brush)
-
-    def hoverEnterEvent(self, a_event):
-        QtGui.QGraphicsRectItem.hoverEnterEvent(self, a_event)
-        if not self.isSelected():
-            self.setBrush(self.hover_brush)
+    def paint(self, a_painter, a_option, a_widget=None):
+        f_editor = self.editor
+        f_times = f_editor.envelope.times
+        f_values = f_editor.envelope.values
+        f_rect = a_option.exposedRect
+        f_first, f_last = self.visible_range(f_rect.left(), f_rect.right())
+        if f_first >= f_last:
+            return
+        f_points = [QtCore.QPointF(f_editor.time_to_x(f_times[i]), f_editor.value_to_y(f_values[i]))
+                for i in range(f_first, f_last)]
+        f_path = QtGui.QPainterPath(f_points[0])
+        for f_time, f_value in zip(*f_editor.envelope.drawn_points(f_first, f_last)):
+            f_path.lineTo(f_editor.time_to_x(f_time), f_editor.value_to_y(f_value))
+        a_painter.setPen(self.line_pen)
+        a_painter.drawPath(f_path)
+        a_painter.setPen(self.point_pen)
+        for i, f_point in enumerate(f_points, f_first):
+            if i in f_editor.selected:
+                a_painter.setBrush(self.s_brush)
+            elif i == f_editor.hover_index:
+                a_painter.setBrush(self.hover_brush)
+            else:
+                a_painter.setBrush(self.o_brush)
+            a_painter.drawEllipse(f_point, self.f_half_size, self.f_half_size)
 
-    def hoverLeaveEvent(self, a_event):
-        QtGui.QGraphicsRectItem.hoverLeaveEvent(self, a_event)
-        if not self.isSelected():
-            self.setBrush(self.o_brush)
-        else:
-            self.setBrush(self.s_brush)
-
-
-    def mousePressEvent(self, a_event):
-        QtGui.QGraphicsEllipseItem.mousePressEvent(self, a_event)
-        self.setGraphicsEffect(QtGui.QGraphicsOpacityEffect())
-        self.select()
-        self.pressed = True
-
-    def mouseMoveEvent(self, a_event):
-        QtGui.QGraphicsEllipseItem.mouseMoveEvent(self, a_event)
-        f_pos_x = self.pos().x()
-        f_pos_y = self.pos().y()
-        if f_pos_x < global_axes_size-self.f_half_size:
-            f_pos_x = global_axes_size-self.f_half_size 
-        elif f_pos_x > global_viewer_width+global_axes_size-self.f_half_size:
-            f_pos_x = global_viewer_width+global_axes_size-self.f_half_size
-        if f_pos_y < global_axes_size-self.f_half_size:
-            f_pos_y = global_axes_size-self.f_half_size 
-        elif f_pos_y > global_viewer_height+global_axes_size-self.f_half_size:
-            f_pos_y = global_viewer_height+global_axes_size-self.f_half_size
-        self.setPos(f_pos_x, f_pos_y)
-
-    def mouseReleaseEvent(self, a_event):
-        a_event.setAccepted(True)
-        self.pressed = False
-        self.setPos(self.pos())
-        QtGui.QGraphicsEllipseItem.mouseReleaseEvent(self, a_event)
-        self.setGraphicsEffect(None)
+    def update_points(self, a_first, a_last):
+        """repaints the points a_first..a_last and the lines touching them"""
+        f_editor = self.editor
+        f_count = len(f_editor.envelope)
+        if not f_count:
+            return
+        f_first = max(0, a_first - 1)
+        f_last = min(f_count - 1, a_last + 1)
+        f_times = f_editor.envelope.times
+        f_values = f_editor.envelope.values
+        f_ys = [f_editor.value_to_y(f_value) for f_value in f_values[f_first:f_last + 1]]
+        f_margin = self.f_half_size + self.line_pen.width()
+        self.update(QtCore.QRectF(
+                QtCore.QPointF(f_editor.time_to_x(f_times[f_first]), min(f_ys)),
+                QtCore.QPointF(f_editor.time_to_x(f_times[f_last]), max(f_ys))
+                ).adjusted(-f_margin, -f_margin, f_margin, f_margin))
 
 class envelope_editor(QtGui.QGraphicsView):
     '''the envelope editor'''
@@ -88,8 +162,20 @@ class envelope_editor(QtGui.QGraphicsView):
         global_axes_size = 28
         self.beat_width = global_viewer_width / self.item_length
         self.value_width = self.beat_width / self.grid_div
-        self.lines = []
+        self.lanes = {} # lane name -> Envelope, this editor's sorted breakpoints
+        self.lane_names = [] # in drawing order
+        self.lane_name = 'automation' # the active lane, the only editable one
+        self.lane_project = None # where lanes not paged in yet are read from
+        self.lane_sections = {} # lane name -> its section number in lane_project
+        self.envelope = self.lanes[self.lane_name] = Envelope()
+        self.lane_names.append(self.lane_name)
+        self.selected = set() # indices of the selected points
+        self.drag_index = None
+        self.drag_origin = None
+        self.hover_index = None
+        self.marquee = None
         QtGui.QGraphicsView.__init__(self)
+        self.viewport().setMouseTracking(True) # for hovering
         self.scene = QtGui.QGraphicsScene(self)
         #self.scene.setBackgroundBrush(QtGui.QColor(100, 100, 100))
         self.scene.setBackgroundBrush(QtGui.QColor(200,200,200))
@@ -102,11 +188,23 @@ class envelope_editor(QtGui.QGraphicsView):
         self.setScene(self.scene)
         self.draw_axes()
         self.draw_grid()
+        self.overlay = lane_overlay(self)
+        self.scene.addItem(self.overlay)
+        self.curve = envelope_curve(self)
+        self.scene.addItem(self.curve)
         self.draw_endpoints(0.0,64)
         self.draw_endpoints(3.99,64)
 
         self.insert_mode = False
-        self.selected_points = [] #could just iterate over global_points for isSelected() but what the hell
+        self.arrow_keys = {QtCore.Qt.Key_Left: (-1.0 / self.grid_div, 0), QtCore.Qt.Key_Right: (1.0 / self.grid_div, 0),
+                QtCore.Qt.Key_Down: (0, -1), QtCore.Qt.Key_Up: (0, 1)}
+        self.shape_keys = {QtCore.Qt.Key_1: LINEAR, QtCore.Qt.Key_2: EXPONENTIAL, QtCore.Qt.Key_3: S_CURVE,
+                QtCore.Qt.Key_4: STEP, QtCore.Qt.Key_5: HOLD}
+        self.set_lfo_wave(LFO_WAVES[0])
+        self.lfo_period = 0.25 # beats
+        self.lfo_origin = None
+        self.recorder = None
+        self.recorded = 0 # recorder points already drawn
 
     def keyPressEvent(self, a_event):
         QtGui.QGraphicsView.keyPressEvent(self, a_event)
@@ -116,37 +214,100 @@ class envelope_editor(QtGui.QGraphicsView):
             else:
                 self.insert_mode = False
         if a_event.key() == QtCore.Qt.Key_Delete or a_event.key() == QtCore.Qt.Key_Backspace:
-            #for point in self.selected_points:
-            for point in global_points:
-                if point.isSelected():
-                    point.deselect()
-                    self.scene.removeItem(point)
-                    global_points.remove(point)
-                    self.connect_points()
-                    
+            self.delete_points(self.selected)
+        elif a_event.key() == QtCore.Qt.Key_L:
+            self.set_active_lane(self.lane_names[(self.lane_names.index(self.lane_name) + 1) % len(self.lane_names)])
+        elif a_event.key() in self.shape_keys:
+            self.shape_selection(self.shape_keys[a_event.key()])
+        elif a_event.key() == QtCore.Qt.Key_W:
+            self.set_lfo_wave(LFO_WAVES[(LFO_WAVES.index(self.lfo_wave) + 1) % len(LFO_WAVES)])
+        elif a_event.key() == QtCore.Qt.Key_I:
+            self.invert_selection()
+        elif a_event.key() in self.arrow_keys:
+            f_time, f_value = self.arrow_keys[a_event.key()]
+            if a_event.modifiers() & QtCore.Qt.ControlModifier:
+                ## ctrl stretches/squashes instead of moving
+                self.scale_selection(2.0 ** (f_time * self.grid_div), 1.25 ** f_value)
+            else:
+                self.move_selection(f_time, f_value)
 
     def sceneMousePressEvent(self, a_event):
         QtGui.QGraphicsScene.mousePressEvent(self.scene, a_event)
-        if not any(point.isSelected() for point in global_points):
-            if self.insert_mode:
-                f_pos_x = a_event.scenePos().x()
-                f_pos_y = a_event.scenePos().y()
-                f_time = (f_pos_x - global_axes_size) / self.beat_width
-                f_value = self.steps - (f_pos_y - global_axes_size) * self.steps / global_viewer_height
-                print f_time,",", f_value
-                self.draw_point(f_time, f_value)
+        f_pos = a_event.scenePos()
+        f_shift = bool(a_event.modifiers() & QtCore.Qt.ShiftModifier)
+        f_index = self.point_at(f_pos)
+        if f_index is not None:
+            if f_shift:
+                self.select_points(self.selected.symmetric_difference([f_index]))
+            elif f_index in self.selected and len(self.selected) > 1:
+                ## dragging one of several selected points moves them all
+                self.drag_origin = f_pos
+            else:
+                self.select_points([f_index])
+                if not self.is_endpoint(f_index):
+                    self.drag_index = f_index
+            return
+        if a_event.modifiers() & QtCore.Qt.ControlModifier:
+            ## ctrl-drag writes an LFO over the dragged time range
+            self.lfo_origin = f_pos
+            self.marquee = QtGui.QGraphicsRectItem(QtCore.QRectF(f_pos, f_pos))
+            self.marquee.setBrush(QtGui.QColor(255, 255, 255, 100))
+            self.marquee.setZValue(2.)
+            self.scene.addItem(self.marquee)
+            return
+        ## in insert mode clicking a line adds a point on it instead
+        f_segment = None if self.insert_mode else self.segment_at(f_pos)
+        if self.insert_mode and not self.selected:
+            f_time = self.x_to_time(f_pos.x())
+            f_value = self.y_to_value(f_pos.y())
+            print f_time,",", f_value
+            self.draw_point(f_time, f_value)
+        elif f_segment is not None:
+            ## clicking a line selects the two points it connects
+            if f_shift:
+                self.select_points(self.selected.union([f_segment, f_segment + 1]))
+            else:
+                self.select_points([f_segment, f_segment + 1])
         else:
-            for point in global_points:
-                point.deselect()
+            if not f_shift:
+                self.select_points([])
+            self.marquee_origin = f_pos
+            self.marquee_selected = set(self.selected)
+            self.marquee = QtGui.QGraphicsRectItem(QtCore.QRectF(f_pos, f_pos))
+            self.marquee.setBrush(QtGui.QColor(255, 255, 255, 100))
+            self.marquee.setZValue(2.)
+            self.scene.addItem(self.marquee)
 
     def sceneMouseMoveEvent(self, a_event):
         QtGui.QGraphicsScene.mouseMoveEvent(self.scene, a_event)
-        if any(point.isSelected() for point in global_points):
-        #if self.scene.mouseGrabberItem():
-            self.connect_points()
+        f_pos = a_event.scenePos()
+        if self.drag_index is not None:
+            self.drag_point(self.drag_index, f_pos)
+        elif self.drag_origin is not None:
+            self.move_selection(self.x_to_time(f_pos.x()) - self.x_to_time(self.drag_origin.x()),
+                    self.y_to_value(f_pos.y()) - self.y_to_value(self.drag_origin.y()))
+            self.drag_origin = f_pos
+        elif self.lfo_origin is not None:
+            self.marquee.setRect(QtCore.QRectF(self.lfo_origin, f_pos).normalized())
+        elif self.marquee is not None:
+            f_rect = QtCore.QRectF(self.marquee_origin, f_pos).normalized()
+            self.marquee.setRect(f_rect)
+            self.select_points(self.marquee_selected.union(self.points_in_rect(f_rect)))
+        else:
+            self.hover_point(self.point_at(f_pos))
 
     def sceneMouseReleaseEvent(self, a_event):
         QtGui.QGraphicsScene.mouseReleaseEvent(self.scene, a_event)
+        self.drag_index = None
+        self.drag_origin = None
+        if self.marquee is not None:
+            self.scene.removeItem(self.marquee)
+            self.marquee = None
+        if self.lfo_origin is not None:
+            f_rect = QtCore.QRectF(self.lfo_origin, a_event.scenePos()).normalized()
+            self.lfo_origin = None
+            self.draw_lfo(self.x_to_time(f_rect.left()), self.x_to_time(f_rect.right()),
+                    self.y_to_value(f_rect.bottom()), self.y_to_value(f_rect.top()))
 
     def draw_axes(self):
         self.x_axis = QtGui.QGraphicsRectItem(0, 0, global_viewer_width, global_axes_size)
@@ -196,51 +357,365 @@ class envelope_editor(QtGui.QGraphicsView):
         self.scene.clear()
         self.draw_axes()
         self.draw_grid()
+        self.envelope = Envelope()
+        self.lanes = {self.lane_name: self.envelope}
+        self.lane_names = [self.lane_name]
+        self.selected = set()
+        self.hover_index = None
+        self.marquee = None
+        self.overlay = lane_overlay(self)
+        self.scene.addItem(self.overlay)
+        self.curve = envelope_curve(self)
+        self.scene.addItem(self.curve)
+
+    # -------------------------------------------------------------------------
+    # Lanes
+
+    def add_lane(self, a_name, a_times = (0.0, 3.99), a_values = (64, 64), a_shapes = None):
+        """adds an envelope (a CC, pitch bend, ...) drawn over the same grid"""
+        if a_name in self.lanes:
+            raise ValueError('lane already exists: {}'.format(a_name))
+        self.lanes[a_name] = Envelope(a_times, a_values, a_shapes)
+        self.lane_names.append(a_name)
+        self.overlay.invalidate(a_name)
+
+    def remove_lane(self, a_name):
+        if len(self.lane_names) < 2:
+            raise ValueError('an envelope editor needs at least one lane')
+        if a_name == self.lane_name:
+            f_index = self.lane_names.index(a_name)
+            self.set_active_lane(self.lane_names[f_index - 1 if f_index else 1])
+        del self.lanes[a_name]
+        self.lane_names.remove(a_name)
+        self.overlay.invalidate(a_name)
+
+    def set_active_lane(self, a_name):
+        """switches the lane the mouse and keys edit"""
+        if a_name == self.lane_name:
+            return
+        ## the lane left behind may have changed while it was active
+        self.overlay.invalidate(self.lane_name)
+        self.lane_name = a_name
+        self.envelope = self.lane(a_name)
+        self.selected = set()
+        self.hover_index = None
+        self.drag_index = None
+        self.drag_origin = None
+        self.curve.update()
+
+    # -------------------------------------------------------------------------
+    # Coordinates
+
+    def time_to_x(self, a_time):
+        return global_axes_size + self.beat_width * a_time
+
+    def value_to_y(self, a_value):
+        return global_axes_size + global_viewer_height / self.steps * (self.steps - a_value)
+
+    def x_to_time(self, a_x):
+        return (a_x - global_axes_size) / self.beat_width
+
+    def y_to_value(self, a_y):
+        return self.steps - (a_y - global_axes_size) * self.steps / global_viewer_height
+
+    # -------------------------------------------------------------------------
+    # Points
+
+    def is_endpoint(self, a_index):
+        return a_index == 0 or a_index == len(self.envelope) - 1
 
-    def connect_points(self):
-        if self.lines:
-            for i in range(len(self.lines)):
-                self.scene.removeItem(self.lines[i])
-
-        if len(global_points) > 1:
-            self.lines = (len(global_points) - 1) * [None]
-            global_points.sort(key=lambda point: point.pos().x())
-            f_line_pen = QtGui.QPen()
-            f_line_pen.setColor(QtGui.QColor(200, 50, 50))
-            f_line_pen.setWidth(4)
-            for i in range(1, len(global_points)):
-                #f_start_x = global_axes_size
-                #f_start_y = global_axes_size+(global_viewer_height/2.0)
-                #f_end_x = global_axes_size+global_viewer_width
-                #f_end_y = global_axes_size+(global_viewer_height/2.0)
-                f_start_x = global_points[(i - 1)].pos().x()
-                f_start_y = global_points[(i - 1)].pos().y()
-                f_end_x = global_points[i].pos().x()
-                f_end_y = global_points[i].pos().y()
-                f_pos_x = f_end_x - f_start_x
-                f_pos_y = f_end_y - f_start_y
-                f_line = QtGui.QGraphicsLineItem(0, 0, f_pos_x, f_pos_y)
-                f_line.setPos(7.5 + f_start_x, 7.5 + f_start_y)
-                f_line.setPen(f_line_pen)
-                self.scene.addItem(f_line)
-                self.lines[i - 1] = f_line
+    def point_at(self, a_pos):
+        """index of the point under a scene position, or None"""
+        f_times = self.envelope.times
+        f_values = self.envelope.values
+        f_radius = self.curve.f_half_size
+        f_first, f_last = self.envelope.span(self.x_to_time(a_pos.x() - f_radius),
+                self.x_to_time(a_pos.x() + f_radius))
+        f_best = None
+        f_best_distance = f_radius * f_radius
+        for i in range(f_first, f_last):
+            f_dx = self.time_to_x(f_times[i]) - a_pos.x()
+            f_dy = self.value_to_y(f_values[i]) - a_pos.y()
+            if f_dx * f_dx + f_dy * f_dy <= f_best_distance:
+                f_best = i
+                f_best_distance = f_dx * f_dx + f_dy * f_dy
+        return f_best
+
+    def segment_at(self, a_pos):
+        """index of the first point of the line under a scene position, or
+        None; only the lines next to the one spanning the x are checked"""
+        f_times = self.envelope.times
+        f_values = self.envelope.values
+        f_count = len(f_times)
+        f_segment = bisect_right(f_times, self.x_to_time(a_pos.x())) - 1
+        f_tolerance = self.curve.line_pen.width() / 2.0 + 2
+        for i in (f_segment, f_segment - 1, f_segment + 1):
+            if not 0 <= i < f_count - 1:
+                continue
+            ## curved, step and hold segments are checked piece by piece
+            f_xs, f_ys = self.envelope.drawn_points(i, i + 2)
+            for j in range(len(f_xs) - 1):
+                f_x0 = self.time_to_x(f_xs[j])
+                f_y0 = self.value_to_y(f_ys[j])
+                f_dx = self.time_to_x(f_xs[j + 1]) - f_x0
+                f_dy = self.value_to_y(f_ys[j + 1]) - f_y0
+                f_length = f_dx * f_dx + f_dy * f_dy
+                if not f_length:
+                    continue
+                ## distance to the closest point of the line
+                f_t = min(1., max(0., ((a_pos.x() - f_x0) * f_dx + (a_pos.y() - f_y0) * f_dy) / f_length))
+                f_ex = f_x0 + f_t * f_dx - a_pos.x()
+                f_ey = f_y0 + f_t * f_dy - a_pos.y()
+                if f_ex * f_ex + f_ey * f_ey <= f_tolerance * f_tolerance:
+                    return i
+        return None
+
+    def points_in_rect(self, a_rect):
+        """indices of the points inside a scene rect, the time range is found
+        with bisect and only the points in it are checked for value"""
+        f_values = self.envelope.values
+        f_first, f_last = self.envelope.span(self.x_to_time(a_rect.left()),
+                self.x_to_time(a_rect.right()))
+        f_top = self.y_to_value(a_rect.top())
+        f_bottom = self.y_to_value(a_rect.bottom())
+        return [i for i in range(f_first, f_last) if f_bottom <= f_values[i] <= f_top]
+
+    def hover_point(self, a_index):
+        if a_index == self.hover_index:
+            return
+        f_old = self.hover_index
+        self.hover_index = a_index
+        for i in (f_old, a_index):
+            if i is not None and i < len(self.envelope):
+                self.curve.update_points(i, i)
+
+    def select_points(self, a_indices):
+        f_changed = self.selected.symmetric_difference(a_indices)
+        self.selected = set(a_indices)
+        for i in f_changed:
+            self.curve.update_points(i, i)
+
+    def drag_point(self, a_index, a_pos):
+        """moves a point, kept inside the axes and between its neighbours;
+        only the two segments touching it are repainted"""
+        f_times = self.envelope.times
+        f_time = self.x_to_time(min(max(a_pos.x(), global_axes_size),
+                global_axes_size + global_viewer_width))
+        f_time = min(max(f_time, f_times[a_index - 1]), f_times[a_index + 1])
+        f_value = self.y_to_value(min(max(a_pos.y(), global_axes_size),
+                global_axes_size + global_viewer_height))
+        self.curve.update_points(a_index, a_index)
+        self.envelope.set_point(a_index, f_time, f_value)
+        self.curve.update_points(a_index, a_index)
 
     def draw_point(self, a_time, a_value):
-        f_time = global_axes_size + self.beat_width * a_time
-        f_value = global_axes_size + global_viewer_height / self.steps * (self.steps - a_value)
-        f_point = envelope_item(f_time, f_value)
-        global_points.append(f_point)
-        self.scene.addItem(f_point)
-        self.connect_points()
+        """adds a point, between the endpoints once there are two"""
+        f_last = None
+        if len(self.envelope) > 1:
+            a_time = min(max(a_time, self.envelope.times[0]), self.envelope.times[-1])
+            f_last = len(self.envelope) - 1 # never after the last endpoint
+        f_index = self.envelope.insert(a_time, a_value, hi = f_last)
+        self.selected = set(i + 1 if i >= f_index else i for i in self.selected)
+        if self.hover_index is not None and self.hover_index >= f_index:
+            self.hover_index += 1
+        self.curve.update_points(f_index, f_index)
+        return f_index
 
     def draw_endpoints(self, a_time, a_value):
-        f_time = global_axes_size + self.beat_width * a_time
-        f_value = global_axes_size + global_viewer_height / self.steps * (self.steps - a_value)
-        f_point = envelope_item(f_time, f_value)
-        f_point.setFlag(QtGui.QGraphicsItem.ItemIsMovable, False)
-        global_points.append(f_point)
-        self.scene.addItem(f_point)
-        self.connect_points()
+        f_index = self.envelope.insert(a_time, a_value)
+        self.curve.update_points(f_index, f_index)
+
+    def delete_points(self, a_indices):
+        """removes points in one pass, the endpoints stay"""
+        f_doomed = [i for i in a_indices if not self.is_endpoint(i)]
+        if not f_doomed:
+            return
+        self.envelope.remove_many(f_doomed)
+        self.selected = set()
+        self.hover_index = None
+        self.curve.update()
+
+    def transform_selection(self, a_function):
+        """a_function(times, values) returns the new times and values of the
+        selected points (endpoints excluded); they are clamped to the editor,
+        written in one model update and redrawn once"""
+        f_indices = sorted(i for i in self.selected if not self.is_endpoint(i))
+        if not f_indices:
+            return
+        f_times = self.envelope.times
+        f_values = self.envelope.values
+        f_new_times, f_new_values = a_function([f_times[i] for i in f_indices],
+                [f_values[i] for i in f_indices])
+        f_start = f_times[0]
+        f_end = f_times[-1]
+        f_new_times = [min(max(f_time, f_start), f_end) for f_time in f_new_times]
+        f_new_values = [min(max(f_value, 0.), self.steps) for f_value in f_new_values]
+        f_fixed = [i for i in self.selected if self.is_endpoint(i)]
+        f_moved = self.envelope.set_many(f_indices, f_new_times, f_new_values)
+        self.selected = set(f_moved + [len(self.envelope) - 1 if i else 0 for i in f_fixed])
+        self.hover_index = None
+        self.curve.update()
+
+    def move_selection(self, a_time, a_value):
+        """moves the selected points by a_time beats and a_value steps"""
+        self.transform_selection(lambda a_times, a_values:
+                ([f_time + a_time for f_time in a_times], [f_value + a_value for f_value in a_values]))
+
+    def scale_selection(self, a_time_scale, a_value_scale):
+        """stretches the selected points in time from the first of them, and
+        in value from the middle of their range"""
+        def f_scale(a_times, a_values):
+            f_start = a_times[0]
+            f_middle = (min(a_values) + max(a_values)) / 2.0
+            return ([f_start + (f_time - f_start) * a_time_scale for f_time in a_times],
+                    [f_middle + (f_value - f_middle) * a_value_scale for f_value in a_values])
+        self.transform_selection(f_scale)
+
+    def invert_selection(self):
+        """flips the values of the selected points upside down"""
+        self.transform_selection(lambda a_times, a_values:
+                (a_times, [self.steps - f_value for f_value in a_values]))
+
+    def shape_selection(self, a_shape):
+        """sets the curve of the lines between selected points, or of the
+        line leaving a point selected on its own"""
+        f_last = len(self.envelope) - 1
+        f_indices = [i for i in self.selected if i < f_last and i + 1 in self.selected]
+        if not f_indices:
+            f_indices = [i for i in self.selected if i < f_last]
+        if not f_indices:
+            return
+        self.envelope.set_shapes(f_indices, a_shape)
+        self.curve.update_points(min(f_indices), max(f_indices) + 1)
+
+    def get_points(self):
+        """returns copies of the points as (times in beats, values 0-127) arrays"""
+        return array('d', self.envelope.times), array('d', self.envelope.values)
+
+    def set_points(self, a_times, a_values, a_shapes = None):
+        """replaces every point, the first and last become the endpoints"""
+        self.envelope.set_points(a_times, a_values, a_shapes)
+        self.selected = set()
+        self.hover_index = None
+        self.curve.update()
+
+    def start_recording(self, a_tolerance = 0.5):
+        """dense automation fed to record() is decimated to points that stay
+        within a_tolerance (in 0-127 steps) of every sample"""
+        self.recorder = Recorder(a_tolerance)
+        self.recorded = 0
+
+    def record(self, a_times, a_values):
+        """adds a block of samples (times in beats, values 0-127), only the
+        points kept by the decimation are drawn"""
+        if self.recorder is None:
+            self.start_recording()
+        self.recorder.add_many(a_times, a_values)
+        self.draw_recorded()
+
+    def stop_recording(self):
+        """ends the recording, replacing the old points under it"""
+        if self.recorder is None:
+            return
+        f_times, f_values = self.recorder.finish()
+        self.recorder = None
+        if f_times:
+            self.replace_points(f_times, f_values)
+
+    def replace_points(self, a_times, a_values, a_shapes = None):
+        """drops every point in the time range of new ones but the endpoints,
+        then merges the new ones in with one model update and one redraw;
+        new points outside the endpoints are left out, like draw_point keeps
+        points between them"""
+        f_envelope = self.envelope
+        if a_shapes is None:
+            a_shapes = [LINEAR] * len(a_times)
+        f_low = a_times[0]
+        f_high = a_times[-1]
+        if len(f_envelope) > 1:
+            f_start = f_envelope.times[0]
+            f_end = f_envelope.times[-1]
+            f_low = min(max(f_low, f_start), f_end)
+            f_high = min(max(f_high, f_start), f_end)
+            f_kept = [i for i in range(len(a_times)) if f_start <= a_times[i] < f_end]
+            a_times = [a_times[i] for i in f_kept]
+            a_values = [a_values[i] for i in f_kept]
+            a_shapes = [a_shapes[i] for i in f_kept]
+        f_first, f_last = f_envelope.span(f_low, f_high)
+        f_envelope.remove_many(i for i in range(f_first, f_last) if not self.is_endpoint(i))
+        if not a_times:
+            self.set_points(f_envelope.times, f_envelope.values, f_envelope.shapes)
+            return
+        ## the new points go after any old one at their start time and before
+        ## the rest, so an endpoint at the same time as the last stays last
+        f_split = bisect_right(f_envelope.times, a_times[0])
+        self.set_points(f_envelope.times[:f_split] + array('d', a_times) + f_envelope.times[f_split:],
+                f_envelope.values[:f_split] + array('d', a_values) + f_envelope.values[f_split:],
+                f_envelope.shapes[:f_split] + array('B', a_shapes) + f_envelope.shapes[f_split:])
+
+    def set_lfo_wave(self, a_wave):
+        """the wave ctrl-drag writes, shown in the view's tooltip"""
+        self.lfo_wave = a_wave
+        self.setToolTip('ctrl-drag LFO: {}'.format(a_wave))
+
+    def draw_lfo(self, a_start, a_end, a_low, a_high):
+        """writes self.lfo_wave every self.lfo_period beats from a_start to
+        a_end, between the a_low and a_high values, in one go"""
+        if len(self.envelope) > 1:
+            a_start = max(a_start, self.envelope.times[0])
+            a_end = min(a_end, self.envelope.times[-1])
+        if a_end - a_start < self.lfo_period:
+            return
+        self.replace_points(*lfo(a_start, a_end, self.lfo_period, max(a_low, 0.),
+                min(a_high, self.steps), self.lfo_wave))
+
+    def draw_recorded(self):
+        f_times = self.recorder.times
+        f_values = self.recorder.values
+        for i in range(self.recorded, len(f_times)):
+            self.draw_point(f_times[i], f_values[i])
+        self.recorded = len(f_times)
+
+    def get_envelope(self, a_lane = None):
+        """a copy of a lane's points (the active lane's by default) as an
+        automation.Envelope, for sampling"""
+        f_envelope = self.lane(a_lane or self.lane_name)
+        return Envelope(f_envelope.times, f_envelope.values, f_envelope.shapes)
+
+    def save_project(self, a_project):
+        """puts the lanes in a project.Project"""
+        a_project.set_text('envelope.lanes', self.lane_names)
+        ## page every lane in first, writing a lane may replace the section
+        ## another one still has to be read from
+        for i, f_envelope in enumerate([self.lane(f_name) for f_name in self.lane_names]):
+            a_project.set('envelope.{}.times'.format(i), f_envelope.times)
+            a_project.set('envelope.{}.values'.format(i), f_envelope.values)
+            a_project.set('envelope.{}.shapes'.format(i), f_envelope.shapes)
+
+    def load_project(self, a_project):
+        """reads the lane names and the first lane's points, the other lanes
+        stay in the file until they are first drawn or used, see lane()"""
+        if 'envelope.lanes' not in a_project:
+            return
+        self.lane_names = a_project.get_text('envelope.lanes')
+        self.lanes = dict((f_name, None) for f_name in self.lane_names)
+        self.lane_project = a_project
+        self.lane_sections = dict((f_name, i) for i, f_name in enumerate(self.lane_names))
+        self.lane_name = self.lane_names[0]
+        self.envelope = self.lane(self.lane_name)
+        self.set_points(self.envelope.times, self.envelope.values, self.envelope.shapes)
+        self.overlay.invalidate()
+
+    def lane(self, a_name):
+        """a lane's Envelope, paged in from the project it was loaded from the
+        first time it is asked for"""
+        f_envelope = self.lanes[a_name]
+        if f_envelope is None:
+            i = self.lane_sections[a_name]
+            f_project = self.lane_project
+            f_envelope = self.lanes[a_name] = Envelope(f_project.get('envelope.{}.times'.format(i)),
+                    f_project.get('envelope.{}.values'.format(i)), f_project.get('envelope.{}.shapes'.format(i)))
+        return f_envelope
 
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
@@ -249,5 +724,7 @@ if __name__ == '__main__':
     view.draw_point(3, 64)
     view.draw_point(0, 0)
     view.draw_point(1, 54)
+    view.add_lane('pitchbend', [f_step / 64.0 for f_step in range(256)],
+            [64 + 40 * ((f_step % 16) - 8) / 8.0 for f_step in range(256)])
     view.show()
     sys.exit(app.exec_())
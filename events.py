@@ -0,0 +1,183 @@
+"""
+Compiled note-on/note-off stream for loop playback
+
+The notes of a NoteStore are compiled to events sorted by tick, kept as
+parallel columns so a playback thread can seek with bisect and walk a block
+of events without building python objects. A note running past the loop end
+has its note-off wrapped around to the start of the loop.
+"""
+from array import array
+from bisect import bisect_left
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+
+class EventStream(object):
+    '''note events of a NoteStore sorted by tick, maintained incrementally'''
+    def __init__(self, store, loop_length):
+        self.store = store
+        self.loop_length = loop_length # ticks
+        ## columns, see clear(); key = tick * 2 + 1 for note-ons and tick * 2
+        ## for note-offs, so offs sort before ons on the same tick
+        self.window = [0, 0, 0, 0] # reused by query
+        self.generation = 0 # bumped on every change, see freeze
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def event(self, i):
+        """(tick, status, pitch, velocity) of the i-th event"""
+        key = self.keys[i]
+        return (key >> 1, NOTE_ON if key & 1 else NOTE_OFF,
+                self.pitches[i], self.velocities[i])
+
+    def note_keys(self, start, length):
+        """sort keys of the note-on and note-off of a note"""
+        loop = self.loop_length
+        return (start % loop) * 2 + 1, ((start + length) % loop) * 2
+
+    # -------------------------------------------------------------------------
+    # Maintenance
+
+    def add(self, note_id):
+        if self.loop_length <= 0:
+            return
+        pitch, start, length, velocity = self.store.get(note_id)
+        on_key, off_key = self.note_keys(start, length)
+        self.compiled[note_id] = (on_key, off_key)
+        self.insert(off_key, note_id, pitch, 0)
+        self.insert(on_key, note_id, pitch, velocity)
+
+    def insert(self, key, note_id, pitch, velocity):
+        self.generation += 1
+        i = bisect_left(self.keys, key + 1) # after equal keys
+        self.keys.insert(i, key)
+        self.note_ids.insert(i, note_id)
+        self.pitches.insert(i, pitch)
+        self.velocities.insert(i, velocity)
+
+    def add_many(self, note_ids):
+        if len(note_ids) > len(self.keys) // 8:
+            self.rebuild()
+            return
+        for note_id in note_ids:
+            self.add(note_id)
+
+    def remove(self, note_id):
+        keys = self.compiled.pop(note_id, None)
+        if keys is None:
+            return
+        self.generation += 1
+        for key in keys:
+            i = bisect_left(self.keys, key)
+            while self.note_ids[i] != note_id:
+                i += 1
+            del self.keys[i]
+            del self.note_ids[i]
+            del self.pitches[i]
+            del self.velocities[i]
+
+    def remove_many(self, note_ids):
+        """drops the events of a batch of notes, compacting the columns in one
+        pass when the batch is large"""
+        doomed = set(note_id for note_id in note_ids if note_id in self.compiled)
+        if len(doomed) < len(self.compiled) // 8:
+            for note_id in doomed:
+                self.remove(note_id)
+            return
+        keep = [i for i, note_id in enumerate(self.note_ids) if note_id not in doomed]
+        self.generation += 1
+        self.keys = array('l', [self.keys[i] for i in keep])
+        self.note_ids = array('l', [self.note_ids[i] for i in keep])
+        self.pitches = array('B', [self.pitches[i] for i in keep])
+        self.velocities = array('B', [self.velocities[i] for i in keep])
+        for note_id in doomed:
+            del self.compiled[note_id]
+
+    def update(self, note_id):
+        """recompiles a note whose pitch, start, length or velocity changed"""
+        self.remove(note_id)
+        if note_id in self.store:
+            self.add(note_id)
+
+    def update_many(self, note_ids):
+        note_ids = list(note_ids)
+        self.remove_many(note_ids)
+        self.add_many([note_id for note_id in note_ids if note_id in self.store])
+
+    def rebuild(self):
+        self.clear()
+        store = self.store
+        loop = self.loop_length
+        if loop <= 0:
+            return
+        events = []
+        for note_id, pitch, start, length, velocity in store.notes():
+            on_key, off_key = self.note_keys(start, length)
+            self.compiled[note_id] = (on_key, off_key)
+            events.append((off_key, note_id, pitch, 0))
+            events.append((on_key, note_id, pitch, velocity))
+        events.sort(key=lambda event: event[0])
+        self.keys = array('l', [event[0] for event in events])
+        self.note_ids = array('l', [event[1] for event in events])
+        self.pitches = array('B', [event[2] for event in events])
+        self.velocities = array('B', [event[3] for event in events])
+
+    def clear(self):
+        self.keys = array('l')
+        self.note_ids = array('l')
+        self.pitches = array('B')
+        self.velocities = array('B')
+        self.compiled = {} # note id -> (on key, off key)
+        self.generation += 1
+
+    def set_loop_length(self, loop_length):
+        """notes wrap differently on a new loop length, so this recompiles"""
+        if loop_length != self.loop_length:
+            self.loop_length = loop_length
+            self.rebuild()
+
+    def freeze(self):
+        """a read-only copy of the events, safe to query from another thread
+        while this stream keeps being edited"""
+        frozen = EventStream.__new__(EventStream)
+        frozen.store = None
+        frozen.loop_length = self.loop_length
+        frozen.window = [0, 0, 0, 0]
+        frozen.generation = self.generation
+        frozen.compiled = {}
+        for column in ('keys', 'note_ids', 'pitches', 'velocities'):
+            setattr(frozen, column, array(getattr(self, column).typecode, getattr(self, column)))
+        return frozen
+
+    # -------------------------------------------------------------------------
+    # Queries
+
+    def query(self, start, end):
+        """index ranges of the events in [start, end) modulo the loop length
+
+        Returns self.window, reused between calls: [lo, hi, lo2, hi2], where
+        events lo..hi-1 come first and lo2..hi2-1 (after the loop wrapped)
+        second. Read the events from the columns or with event(i).
+        """
+        window = self.window
+        keys = self.keys
+        loop = self.loop_length
+        if loop <= 0:
+            window[0] = window[1] = window[2] = window[3] = 0
+            return window
+        if end - start >= loop:
+            start, end = start % loop, start % loop + loop
+        else:
+            end = start % loop + (end - start)
+            start = start % loop
+        window[0] = bisect_left(keys, start * 2)
+        if end <= loop:
+            window[1] = bisect_left(keys, end * 2)
+            window[2] = window[3] = 0
+        else:
+            window[1] = len(keys)
+            window[2] = 0
+            window[3] = bisect_left(keys, (end - loop) * 2)
+        return window
@@ -0,0 +1,204 @@
+"""
+Undo/redo history for NoteStore edits
+
+Every edit is kept as the ids it touched plus copies of only the columns it
+changed, so undoing a move of thousands of notes is one batched write per
+column. The log is capped by memory; the oldest edits are dropped first.
+"""
+from array import array
+
+COLUMNS = ('pitches', 'starts', 'lengths', 'velocities')
+
+class NoteEdit(object):
+    '''one undoable change to a NoteStore'''
+    def __init__(self, kind, note_ids, before=None, after=None):
+        self.kind = kind # 'insert', 'delete' or 'update'
+        self.note_ids = array('l', note_ids)
+        self.before = before or {} # column name -> array, before the edit
+        self.after = after or {} # column name -> array, after the edit
+
+    @classmethod
+    def insert(cls, store, note_ids):
+        """call after the notes were added"""
+        note_ids = array('l', note_ids)
+        return cls('insert', note_ids, after=snapshot(store, note_ids, COLUMNS))
+
+    @classmethod
+    def delete(cls, store, note_ids):
+        """call before the notes are removed"""
+        note_ids = array('l', note_ids)
+        return cls('delete', note_ids, before=snapshot(store, note_ids, COLUMNS))
+
+    @classmethod
+    def update(cls, store, note_ids, columns):
+        """call before changing columns of the notes, then capture() after"""
+        note_ids = array('l', note_ids)
+        return cls('update', note_ids, before=snapshot(store, note_ids, columns))
+
+    def capture(self, store):
+        """records the state after an update"""
+        self.after = snapshot(store, self.note_ids, self.before.keys())
+        return self
+
+    def columns(self):
+        return tuple(self.before or self.after)
+
+    def nbytes(self):
+        total = self.note_ids.itemsize * len(self.note_ids)
+        for data in list(self.before.values()) + list(self.after.values()):
+            total += data.itemsize * len(data)
+        return total
+
+    def can_merge(self, other):
+        return (self.kind == other.kind == 'update'
+                and sorted(self.before) == sorted(other.before)
+                and self.note_ids == other.note_ids)
+
+    def merge(self, other):
+        """folds a later edit of the same notes into this one"""
+        self.after = other.after
+
+    def undo(self, store):
+        """reverts the edit, returns (removed ids, touched ids)"""
+        if self.kind == 'insert':
+            return remove(store, self.note_ids), []
+        elif self.kind == 'delete':
+            return [], restore(store, self.note_ids, self.before)
+        return [], write(store, self.note_ids, self.before)
+
+    def redo(self, store):
+        """applies the edit again, returns (removed ids, touched ids)"""
+        if self.kind == 'insert':
+            return [], restore(store, self.note_ids, self.after)
+        elif self.kind == 'delete':
+            return remove(store, self.note_ids), []
+        return [], write(store, self.note_ids, self.after)
+
+class EditGroup(object):
+    '''several NoteEdits made by one action, undone and redone together'''
+    kind = 'group'
+
+    def __init__(self, edits):
+        self.edits = list(edits)
+
+    def columns(self):
+        columns = []
+        for edit in self.edits:
+            columns.extend(column for column in edit.columns() if column not in columns)
+        return tuple(columns)
+
+    def nbytes(self):
+        return sum(edit.nbytes() for edit in self.edits)
+
+    def can_merge(self, other):
+        return False
+
+    def undo(self, store):
+        return combine(edit.undo(store) for edit in reversed(self.edits))
+
+    def redo(self, store):
+        return combine(edit.redo(store) for edit in self.edits)
+
+class History(object):
+    '''a memory bounded undo/redo log of NoteEdits'''
+    def __init__(self, memory_limit=32 * 1024 * 1024):
+        self.memory_limit = memory_limit
+        self.undo_stack = []
+        self.redo_stack = []
+        self.memory = 0
+        self.last_key = None
+
+    def record(self, edit, coalesce=None):
+        """adds an edit; consecutive edits sharing a coalesce key (e.g. one
+        mouse drag) are merged into a single entry"""
+        for old in self.redo_stack:
+            self.memory -= old.nbytes()
+        self.redo_stack = []
+        last = self.undo_stack[-1] if self.undo_stack else None
+        if coalesce is not None and coalesce == self.last_key and last.can_merge(edit):
+            self.memory -= last.nbytes()
+            last.merge(edit)
+            self.memory += last.nbytes()
+        else:
+            self.undo_stack.append(edit)
+            self.memory += edit.nbytes()
+        self.last_key = coalesce
+        self.trim()
+
+    def trim(self):
+        while self.memory > self.memory_limit and len(self.undo_stack) > 1:
+            self.memory -= self.undo_stack.pop(0).nbytes()
+
+    def can_undo(self):
+        return bool(self.undo_stack)
+
+    def can_redo(self):
+        return bool(self.redo_stack)
+
+    def undo(self, store):
+        if not self.undo_stack:
+            return None
+        edit = self.undo_stack.pop()
+        self.redo_stack.append(edit)
+        self.last_key = None
+        return edit, edit.undo(store)
+
+    def redo(self, store):
+        if not self.redo_stack:
+            return None
+        edit = self.redo_stack.pop()
+        self.undo_stack.append(edit)
+        self.last_key = None
+        return edit, edit.redo(store)
+
+    def clear(self):
+        self.__init__(self.memory_limit)
+
+# -----------------------------------------------------------------------------
+# Helper Functions
+
+def combine(results):
+    """merges the (removed ids, touched ids) of several edits"""
+    removed = []
+    touched = []
+    for edit_removed, edit_touched in results:
+        removed.extend(edit_removed)
+        touched.extend(edit_touched)
+    return removed, touched
+
+def snapshot(store, note_ids, columns):
+    rows = store.rows
+    state = {}
+    for column in columns:
+        data = getattr(store, column)
+        state[column] = array(data.typecode, [data[rows[note_id]] for note_id in note_ids])
+    return state
+
+def present(store, note_ids, state):
+    """drops ids that are no longer in the store (e.g. trimmed by a measure change)"""
+    rows = store.rows
+    if all(note_id in rows for note_id in note_ids):
+        return note_ids, state
+    keep = [i for i, note_id in enumerate(note_ids) if note_id in rows]
+    return (array('l', [note_ids[i] for i in keep]),
+            dict((column, [data[i] for i in keep]) for column, data in state.items()))
+
+def write(store, note_ids, state):
+    note_ids, state = present(store, note_ids, state)
+    for column, values in state.items():
+        store.set_many(note_ids, column, values)
+    return note_ids
+
+def remove(store, note_ids):
+    note_ids = [note_id for note_id in note_ids if note_id in store.rows]
+    store.remove_many(note_ids)
+    return note_ids
+
+def restore(store, note_ids, state):
+    missing = [i for i, note_id in enumerate(note_ids) if note_id not in store.rows]
+    if len(missing) != len(note_ids):
+        note_ids = array('l', [note_ids[i] for i in missing])
+        state = dict((column, [data[i] for i in missing]) for column, data in state.items())
+    store.add_many(state['pitches'], state['starts'], state['lengths'],
+            state['velocities'], note_ids)
+    return note_ids
@@ -0,0 +1,102 @@
+"""
+A pitch x time index over a NoteStore
+
+Notes are bucketed by pitch and by fixed-length slices of time so hit tests
+and marquee queries only look at the notes near the area being asked about,
+not at every note in the clip.
+"""
+class NoteIndex(object):
+    '''grid bucket index of the notes in a NoteStore'''
+    def __init__(self, store, bucket_length=1920):
+        self.store = store
+        self.bucket_length = bucket_length # ticks
+        self.buckets = {} # (pitch, bucket) -> set of note ids
+        self.extents = {} # note id -> (pitch, first bucket, last bucket)
+        self.rebuild()
+
+    def __len__(self):
+        return len(self.extents)
+
+    def span(self, start, end):
+        """first and last bucket touched by the time range [start, end]"""
+        first = int(start // self.bucket_length)
+        last = int(end // self.bucket_length)
+        return first, max(first, last)
+
+    # -------------------------------------------------------------------------
+    # Maintenance
+
+    def add(self, note_id):
+        pitch, start, length, velocity = self.store.get(note_id)
+        first, last = self.span(start, start + length)
+        for bucket in range(first, last + 1):
+            self.buckets.setdefault((pitch, bucket), set()).add(note_id)
+        self.extents[note_id] = (pitch, first, last)
+
+    def add_many(self, note_ids):
+        for note_id in note_ids:
+            self.add(note_id)
+
+    def remove(self, note_id):
+        extent = self.extents.pop(note_id, None)
+        if extent is None:
+            return
+        pitch, first, last = extent
+        for bucket in range(first, last + 1):
+            key = (pitch, bucket)
+            ids = self.buckets[key]
+            ids.discard(note_id)
+            if not ids:
+                del self.buckets[key]
+
+    def remove_many(self, note_ids):
+        for note_id in note_ids:
+            self.remove(note_id)
+
+    def update(self, note_id):
+        """re-buckets a note after its pitch, start or length changed"""
+        self.remove(note_id)
+        self.add(note_id)
+
+    def update_many(self, note_ids):
+        for note_id in note_ids:
+            self.update(note_id)
+
+    def rebuild(self):
+        self.buckets = {}
+        self.extents = {}
+        self.add_many(self.store)
+
+    def clear(self):
+        self.buckets = {}
+        self.extents = {}
+
+    # -------------------------------------------------------------------------
+    # Queries
+
+    def query(self, start, end, low_pitch=0, high_pitch=127):
+        """ids of notes between two pitches (inclusive) that overlap [start, end]"""
+        if end < start or high_pitch < low_pitch:
+            return set()
+        first, last = self.span(start, end)
+        candidates = set()
+        buckets = self.buckets
+        for pitch in range(max(0, int(low_pitch)), min(127, int(high_pitch)) + 1):
+            for bucket in range(first, last + 1):
+                ids = buckets.get((pitch, bucket))
+                if ids:
+                    candidates.update(ids)
+        rows = self.store.rows
+        starts = self.store.starts
+        lengths = self.store.lengths
+        found = set()
+        for note_id in candidates:
+            row = rows[note_id]
+            note_start = starts[row]
+            if note_start <= end and note_start + lengths[row] > start:
+                found.add(note_id)
+        return found
+
+    def at(self, pitch, time):
+        """ids of the notes of one pitch sounding at a point in time"""
+        return self.query(time, time, pitch, pitch)
@@ -0,0 +1,205 @@
+"""
+A Qt-independent note store for the piano roll
+
+Notes are kept as parallel columns (struct-of-arrays) instead of one python
+list per note, so a clip can be loaded, queried and edited without building a
+scene item for each note.
+"""
+import struct
+import sys
+from array import array
+
+## clipboard buffers: magic, version, note count, then the columns
+PACK_MAGIC = b'SQNT'
+PACK_VERSION = 2
+PACK_HEADER = struct.Struct('<4sBI')
+
+class NoteStore(object):
+    '''columnar storage of notes addressed by stable ids'''
+    def __init__(self):
+        self.ids = array('l')
+        self.pitches = array('B')
+        self.starts = array('l') # ticks, see ticks.PPQ
+        self.lengths = array('l')
+        self.velocities = array('B')
+        self.rows = {} # note id -> row in the columns
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, note_id):
+        return note_id in self.rows
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    # -------------------------------------------------------------------------
+    # Editing
+
+    def add(self, pitch, start, length, velocity):
+        """adds a single note and returns its id"""
+        note_id = self.next_id
+        self.next_id += 1
+        self.rows[note_id] = len(self.ids)
+        self.ids.append(note_id)
+        self.pitches.append(int(pitch))
+        self.starts.append(int(start))
+        self.lengths.append(int(length))
+        self.velocities.append(int(velocity))
+        return note_id
+
+    def add_many(self, pitches, starts, lengths, velocities, note_ids=None):
+        """adds a batch of notes given as parallel sequences, returns their ids
+
+        note_ids: reuse these ids instead of allocating new ones (undo)
+        """
+        count = len(pitches)
+        if not count == len(starts) == len(lengths) == len(velocities):
+            raise ValueError('note columns differ in length')
+        first_row = len(self.ids)
+        if note_ids is None:
+            new_ids = array('l', range(self.next_id, self.next_id + count))
+            self.next_id += count
+        else:
+            new_ids = array('l', note_ids)
+            if new_ids:
+                self.next_id = max(self.next_id, max(new_ids) + 1)
+        self.ids.extend(new_ids)
+        self.pitches.extend(array('B', pitches))
+        self.starts.extend(array('l', starts))
+        self.lengths.extend(array('l', lengths))
+        self.velocities.extend(array('B', velocities))
+        for i, note_id in enumerate(new_ids):
+            self.rows[note_id] = first_row + i
+        return new_ids
+
+    def remove(self, note_id):
+        """removes one note by moving the last row into its place"""
+        row = self.rows.pop(note_id)
+        last = len(self.ids) - 1
+        if row != last:
+            moved_id = self.ids[last]
+            self.ids[row] = moved_id
+            self.pitches[row] = self.pitches[last]
+            self.starts[row] = self.starts[last]
+            self.lengths[row] = self.lengths[last]
+            self.velocities[row] = self.velocities[last]
+            self.rows[moved_id] = row
+        for column in self.columns():
+            column.pop()
+
+    def remove_many(self, note_ids):
+        """removes a batch of notes in a single compaction pass"""
+        doomed = set(note_id for note_id in note_ids if note_id in self.rows)
+        if not doomed:
+            return
+        keep = [row for row, note_id in enumerate(self.ids) if note_id not in doomed]
+        self.ids = array('l', [self.ids[row] for row in keep])
+        self.pitches = array('B', [self.pitches[row] for row in keep])
+        self.starts = array('l', [self.starts[row] for row in keep])
+        self.lengths = array('l', [self.lengths[row] for row in keep])
+        self.velocities = array('B', [self.velocities[row] for row in keep])
+        self.rows = dict((note_id, row) for row, note_id in enumerate(self.ids))
+
+    def clear(self):
+        """removes every note, ids are not reused afterwards"""
+        next_id = self.next_id
+        self.__init__()
+        self.next_id = next_id
+
+    def set(self, note_id, pitch=None, start=None, length=None, velocity=None):
+        row = self.rows[note_id]
+        if pitch is not None: self.pitches[row] = int(pitch)
+        if start is not None: self.starts[row] = int(start)
+        if length is not None: self.lengths[row] = int(length)
+        if velocity is not None: self.velocities[row] = int(velocity)
+
+    def set_many(self, note_ids, column, values):
+        """writes one column ('pitches', 'starts', ...) for a batch of notes"""
+        data = getattr(self, column)
+        rows = self.rows
+        for note_id, value in zip(note_ids, values):
+            data[rows[note_id]] = value
+
+    # -------------------------------------------------------------------------
+    # Queries
+
+    def columns(self):
+        return (self.ids, self.pitches, self.starts, self.lengths, self.velocities)
+
+    def get(self, note_id):
+        """returns [num, start, length, velocity] like the old NoteItem.note"""
+        row = self.rows[note_id]
+        return [self.pitches[row], self.starts[row],
+                self.lengths[row], self.velocities[row]]
+
+    def notes(self):
+        """yields (id, num, start, length, velocity) for every note"""
+        for row in range(len(self.ids)):
+            yield (self.ids[row], self.pitches[row], self.starts[row],
+                    self.lengths[row], self.velocities[row])
+
+    def find(self, start=None, end=None, low_pitch=0, high_pitch=127):
+        """ids of notes sounding in [start, end) between two pitches (inclusive)"""
+        found = []
+        for row in range(len(self.ids)):
+            pitch = self.pitches[row]
+            if pitch < low_pitch or pitch > high_pitch:
+                continue
+            if end is not None and self.starts[row] >= end:
+                continue
+            if start is not None and self.starts[row] + self.lengths[row] <= start:
+                continue
+            found.append(self.ids[row])
+        return found
+
+    # -------------------------------------------------------------------------
+    # Serialization
+
+    def pack(self, note_ids):
+        """serializes notes to a compact buffer, starts relative to the earliest
+        one so the buffer can be pasted anywhere"""
+        rows = [self.rows[note_id] for note_id in note_ids]
+        offset = min(self.starts[row] for row in rows) if rows else 0
+        columns = (
+            array('i', [self.starts[row] - offset for row in rows]),
+            array('i', [self.lengths[row] for row in rows]),
+            array('B', [self.pitches[row] for row in rows]),
+            array('B', [self.velocities[row] for row in rows]))
+        return PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(rows)) \
+                + b''.join(to_bytes(column) for column in columns)
+
+def unpack(data):
+    """reads a buffer made by NoteStore.pack, returns the columns
+    (pitches, starts, lengths, velocities) ready for NoteStore.add_many"""
+    data = bytes(data)
+    magic, version, count = PACK_HEADER.unpack_from(data)
+    if magic != PACK_MAGIC or version != PACK_VERSION:
+        raise ValueError('not a note buffer')
+    columns = []
+    offset = PACK_HEADER.size
+    for typecode in ('i', 'i', 'B', 'B'):
+        column = array(typecode)
+        size = column.itemsize * count
+        from_bytes(column, data[offset:offset + size])
+        columns.append(column)
+        offset += size
+    starts, lengths, pitches, velocities = columns
+    return pitches, starts, lengths, velocities
+
+def to_bytes(column):
+    """little endian bytes of an array"""
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes() if hasattr(column, 'tobytes') else column.tostring()
+
+def from_bytes(column, data):
+    """appends little endian bytes to an array"""
+    if hasattr(column, 'frombytes'):
+        column.frombytes(data)
+    else:
+        column.fromstring(data)
+    if sys.byteorder == 'big' and column.itemsize > 1:
+        column.byteswap()
@@ -3,7 +3,21 @@ A piano roll viewer/editor
 
 """
 
+import math
+from array import array
+
 from PyQt4 import QtGui, QtCore
+from note_store import NoteStore, unpack
+from note_index import NoteIndex
+from history import History, NoteEdit, EditGroup
+from ticks import PPQ, WHOLE_NOTE, grid_ticks, snap_tick, ticks_to_px
+from quantize import quantize
+from transport import Transport
+from events import EventStream
+from playback import PlaybackEngine
+from smf import read_columns, write_notes
+
+NOTE_MIME_TYPE = 'application/x-seq-gui-notes'
 
 class NoteExpander(QtGui.QGraphicsRectItem):
     def __init__(self, length, height, parent):
@@ -41,18 +55,12 @@ class NoteExpander(QtGui.QGraphicsRectItem):
             self.parent.setBrush(self.parent.orig_brush)
         self.setBrush(self.orig_brush)
 
-class NoteWrap(QtGui.QGraphicsRectItem):
-    def __init__(self, length, height, parent):
-        QtGui.QGraphicsRectItem.__init__(self, 0, 0, length, height, parent)
-        self.parent = parent
-
 class NoteItem(QtGui.QGraphicsRectItem):
     '''a note on the pianoroll sequencer'''
-    def __init__(self, height, length, note_info):
+    def __init__(self, height, length, note_id):
         QtGui.QGraphicsRectItem.__init__(self, 0, 0, length, height)
         
         self.setFlag(QtGui.QGraphicsItem.ItemIsMovable)
-        self.setFlag(QtGui.QGraphicsItem.ItemIsSelectable)
         self.setFlag(QtGui.QGraphicsItem.ItemSendsGeometryChanges)
         self.setAcceptHoverEvents(True)
 
@@ -63,30 +71,48 @@ class NoteItem(QtGui.QGraphicsRectItem):
         self.select_brush = QtGui.QColor(200, 100, 100)
         self.setBrush(self.orig_brush)
             
-        self.note = note_info
+        self.note_id = note_id
         self.length = length
         self.piano = self.scene
 
         self.pressed = False
         self.hovering = False
-        self.moving_diff = (0,0)
-        self.expand_diff = 0
+        self.selected = False
 
         l = 5
         self.front = NoteExpander(l, height, self)
         self.back = NoteExpander(l, height, self)
         self.back.setPos(length - l, 0)
 
+    def bind(self, note_id, pos_x, pos_y, length, selected=False):
+        """points this (possibly recycled) item at another note"""
+        self.note_id = note_id
+        self.length = length
+        self.setRect(0, 0, length, self.rect().height())
+        self.back.setPos(length - self.back.rect().width(), 0)
+        self.setPos(pos_x, pos_y)
+        self.pressed = False
+        self.hovering = False
+        self.front.stretch = False
+        self.back.stretch = False
+        self.orig_brush = QtGui.QColor(100, 0, 0)
+        self.select_brush = QtGui.QColor(200, 100, 100)
+        self.setSelected(selected)
+
     def paint(self, painter, option, widget=None):
         paint_option = option
         paint_option.state &= ~QtGui.QStyle.State_Selected
         QtGui.QGraphicsRectItem.paint(self, painter, paint_option, widget)
 
     def setSelected(self, boolean):
-        QtGui.QGraphicsRectItem.setSelected(self, boolean)
+        """selection is owned by the scene (PianoRoll.selected), this only shows it"""
+        self.selected = boolean
         if boolean: self.setBrush(self.select_brush)
         else: self.setBrush(self.orig_brush)
 
+    def isSelected(self):
+        return self.selected
+
     def hoverEnterEvent(self, event):
         self.hovering = True
         QtGui.QGraphicsRectItem.hoverEnterEvent(self, event)
@@ -109,130 +135,96 @@ class NoteItem(QtGui.QGraphicsRectItem):
     def mouseMoveEvent(self, event):
         pass
 
-    def moveEvent(self, event):
-        offset = event.scenePos() - event.lastScenePos()
-
-        if self.back.stretch:
-            self.expand(self.back, offset)
-        else:
-            self.move_pos = self.scenePos() + offset \
-                    + QtCore.QPointF(self.moving_diff[0],self.moving_diff[1])
-            pos = self.piano().enforce_bounds(self.move_pos)
-            pos_x, pos_y = pos.x(), pos.y()
-            pos_sx, pos_sy = self.piano().snap(pos_x, pos_y)
-            self.moving_diff = (pos_x-pos_sx, pos_y-pos_sy)
-            if self.front.stretch:
-                right = self.rect().right() - offset.x() + self.expand_diff
-                if (self.scenePos().x() == self.piano().piano_width and offset.x() < 0) \
-                        or right < 10:
-                    self.expand_diff = 0
-                    return
-                self.expand(self.front, offset)
-                self.setPos(pos_sx, self.scenePos().y())
-            else:
-                self.setPos(pos_sx, pos_sy)
-
-    def expand(self, rectItem, offset):
-        rect = self.rect()
-        right = rect.right() + self.expand_diff
-        if rectItem == self.back:
-            right += offset.x()
-            if right > self.piano().grid_width:
-                right = self.piano().grid_width
-            elif right < 10:
-                right = 10
-            new_x = self.piano().snap(right)
-        else:
-            right -= offset.x()
-            new_x = self.piano().snap(right+2.75)
-        if self.piano().snap_value: new_x -= 2.75 # where does this number come from?!
-        self.expand_diff = right - new_x
-        self.back.setPos(new_x - 5, 0)
-        rect.setRight(new_x)
-        self.setRect(rect)
-    
-    def updateNoteInfo(self, pos_x, pos_y):
-            self.note[0] = self.piano().get_note_num_from_y(pos_y)
-            self.note[1] = self.piano().get_note_start_from_x(pos_x)
-            self.note[2] = self.piano().get_note_length_from_x(
-                    self.rect().right() - self.rect().left())
-            print("note: {}".format(self.note))
-
     def mouseReleaseEvent(self, event):
-        QtGui.QGraphicsRectItem.mouseReleaseEvent(self, event)
+        """the scene moves and stretches notes as a group, see SelectionDrag"""
         self.pressed = False
-        if event.button() == QtCore.Qt.LeftButton:
-            self.moving_diff = (0,0)
-            self.expand_diff = 0
-            self.back.stretch = False
-            self.front.stretch = False
-            (pos_x, pos_y,) = self.piano().snap(self.pos().x(), self.pos().y())
-            self.setPos(pos_x, pos_y)
-            self.updateNoteInfo(pos_x, pos_y)
-
-    def updateVelocity(self, event):
-        offset = event.scenePos().x() - event.lastScenePos().x()
-        self.note[3] += int(offset/5)
-        if self.note[3] > 127:
-            self.note[3] = 127
-        elif self.note[3] < 0:
-            self.note[3] = 0
-        print("new vel: {}".format(self.note[3]))
-        self.orig_brush = QColor(self.note[3], 0, 0)
-        self.select_brush = QColor(self.note[3] + 100, 100, 100)
-        self.setBrush(self.orig_brush)
-
-class PianoKeyItem(QtGui.QGraphicsRectItem):
-    def __init__(self, width, height, parent):
-        QtGui.QGraphicsRectItem.__init__(self, 0, 0, width, height, parent)
-        self.setPen(QtGui.QPen(QtGui.QColor(0,0,0,80)))
-        self.width = width
-        self.height = height
-        self.setFlag(QtGui.QGraphicsItem.ItemSendsGeometryChanges)
-        self.setAcceptHoverEvents(True)
-        self.hover_brush = QtGui.QColor(200, 0, 0)
-        self.click_brush = QtGui.QColor(255, 100, 100)
-        self.pressed = False
-
-    def hoverEnterEvent(self, event):
-        QtGui.QGraphicsRectItem.hoverEnterEvent(self, event)
-        self.orig_brush = self.brush()
-        self.setBrush(self.hover_brush)
-
-    def hoverLeaveEvent(self, event):
-        if self.pressed:
-            self.pressed = False
-            self.setBrush(self.hover_brush)
-        QtGui.QGraphicsRectItem.hoverLeaveEvent(self, event)
-        self.setBrush(self.orig_brush)
-
-    #def mousePressEvent(self, event):
-    #    self.pressed = True
-    #    self.setBrush(self.click_brush)
-
-    def mouseMoveEvent(self, event):
-        """this may eventually do something"""
-        pass
+        self.back.stretch = False
+        self.front.stretch = False
+
+    def showVelocity(self, velocity):
+        self.orig_brush = QtGui.QColor(velocity, 0, 0)
+        self.select_brush = QtGui.QColor(min(velocity + 100, 255), 100, 100)
+        self.setSelected(self.selected)
+
+class SelectionDrag(QtGui.QGraphicsItem):
+    '''stands in for the selected notes while they are moved or stretched
+
+    The notes' rects are captured once when the drag starts; every mouse move
+    only changes the offset, and the note data is written back in one batch
+    on release (PianoRoll.endSelectionDrag).
+    '''
+    def __init__(self, note_ids, rects, anchor, mode):
+        QtGui.QGraphicsItem.__init__(self)
+        self.note_ids = note_ids
+        self.rects = rects
+        self.anchor = anchor # rect of the note under the mouse
+        self.mode = mode # 'move', 'front' or 'back'
+        self.dx = 0
+        self.dy = 0
+        self.bounds = QtCore.QRectF()
+        for rect in rects:
+            self.bounds = self.bounds.united(rect)
+        self.min_width = min(rect.width() for rect in rects)
+        self.brush = QtGui.QColor(200, 100, 100, 150)
+        self.setZValue(2.)
+
+    def setOffset(self, dx, dy):
+        if (dx, dy) == (self.dx, self.dy):
+            return
+        self.prepareGeometryChange()
+        self.dx = dx
+        self.dy = dy
+
+    def boundingRect(self):
+        if self.mode == 'move':
+            return self.bounds.translated(self.dx, self.dy)
+        elif self.mode == 'back':
+            return self.bounds.adjusted(0, 0, max(self.dx, 0), 0)
+        return self.bounds.adjusted(min(self.dx, 0), 0, 0, 0)
 
-    def mouseReleaseEvent(self, event):
-        self.pressed = False
-        QtGui.QGraphicsRectItem.mouseReleaseEvent(self, event)
-        self.setBrush(self.hover_brush)
+    def paint(self, painter, option, widget=None):
+        painter.setPen(QtGui.QPen(QtGui.QColor(0,0,0,0)))
+        painter.setBrush(self.brush)
+        if self.mode == 'move':
+            painter.translate(self.dx, self.dy)
+            painter.drawRects(self.rects)
+        elif self.mode == 'back':
+            painter.drawRects([rect.adjusted(0, 0, self.dx, 0) for rect in self.rects])
+        else:
+            painter.drawRects([rect.adjusted(self.dx, 0, 0, 0) for rect in self.rects])
 
 class PianoRoll(QtGui.QGraphicsScene):
     '''the piano roll'''
 
     measureupdate = QtCore.pyqtSignal(int)
     modeupdate = QtCore.pyqtSignal(str)
+    notesChanged = QtCore.pyqtSignal() # at most once per frame, see frameTick
+    viewChanged = QtCore.pyqtSignal()
 
     def __init__(self, time_sig = '4/4', num_measures = 4, quantize_val = '1/8'):
         QtGui.QGraphicsScene.__init__(self)
         self.setBackgroundBrush(QtGui.QColor(50, 50, 50))
         self.mousePos = QtCore.QPointF()
 
-        self.notes = []
-        self.selected_notes = []
-        self.piano_keys = []
+        self.note_store = NoteStore()
+        self.note_index = NoteIndex(self.note_store, bucket_length=PPQ)
+        self.event_stream = EventStream(self.note_store, 0) # loop playback, see events.py
+        self.last_update_cost = {'notes': 0, 'items': 0}
+        self.history = History()
+        self.pending_project = None # notes not paged in yet, see loadProject
+        self.clipboard = b'' # last copied notes, see NoteStore.pack
+        self.gesture = 0 # bumped on every mouse press, edits in one gesture coalesce
+        self.note_items = {} # note id -> NoteItem
+        self.selected = set() # ids of the selected notes
+        self.pressed_note = None
+        self.piano_pressed = False
+        self.selection_drag = None
+        self.min_note_width = 10
+
+        ## only notes near the viewport get a scene item, see updateNoteItems
+        self.visible_rect = None
+        self.visible_margin = 100
+        self.item_pool = []
 
         self.marquee_select = False
         self.insert_mode = False
@@ -264,67 +256,135 @@ class PianoRoll(QtGui.QGraphicsScene):
 
         ## width 
         self.full_note_width = 250 # i.e. a 4/4 note
-        self.snap_value = None
+        self.px_per_tick = self.full_note_width / float(WHOLE_NOTE)
+        self.snap_grid = None # exact grid step in ticks, see ticks.grid_ticks
         self.quantize_val = quantize_val
 
         ### dummy vars that will be changed
         self.time_sig = 0
         self.measure_width = 0
         self.num_measures = 0
-        self.max_note_length = 0
+        self.clip_length = 0 # in ticks
         self.grid_width = 0
         self.value_width = 0
         self.grid_div = 0
-        self.piano = None
-        self.header = None
-        self.play_head = None
+        self.play_head_x = 0. # relative to the start of the grid
+        self.play_head_pen = QtGui.QPen(QtGui.QColor(255,255,255,50), 2)
+
+        ## the grid and keyboard are painted, not items, see sceneTiles
+        self.black_notes = (1, 3, 6, 8, 10)
+        self.tile_size = 256
+        self.tile_generation = 0
+        self.hovered_key = None
+        self.key_hover_brush = QtGui.QColor(200, 0, 0)
 
         self.setTimeSig(time_sig)
         self.setMeasures(num_measures)
         self.setGridDiv()
         self.default_length = 1. / self.grid_div
 
+        ## host positions are taken once per frame, see flushTransport
+        self.transport = Transport()
+        self.frame_interval = 16 # ms, about one display refresh
+        self.transport_timer = QtCore.QTimer(self)
+        self.transport_timer.timeout.connect(self.frameTick)
+        self.transport_timer.start(self.frame_interval)
+        self.playback = None # PlaybackEngine, see startPlayback
+        self.published_generation = None
+        self.notified_generation = None
+
 
     # -------------------------------------------------------------------------
     # Callbacks
 
     def genTransport(self, pos):
-        print pos
-        bar, pos = pos / (1920*int(self.time_sig[0])), pos % (1920*int(self.time_sig[0]))
-        beat, tick = pos / 1920, pos % 1920
-        print "{} | {} | {}".format(bar, beat, tick)
-        transport_info = {
-                "bar": bar,
-                "beat": beat,
-                "tick": tick,
-                }
-        self.movePlayHead(transport_info)
+        """pos: host ticks, 1920 per time signature beat
+
+        Safe to call from any thread at any rate, the play head follows the
+        newest position once per frame.
+        """
+        self.transport.post(pos)
+
+    def frameTick(self):
+        self.flushTransport()
+        if self.event_stream.generation != self.notified_generation:
+            self.notified_generation = self.event_stream.generation
+            self.notesChanged.emit()
+
+    def flushTransport(self):
+        if self.playback is not None:
+            self.publishEvents()
+            self.setPlayHead(self.playback.ticks())
+        pos = self.transport.take()
+        if pos is None:
+            return
+        if self.setPlayHead(pos * WHOLE_NOTE / self.time_sig[1] / 1920.):
+            self.transport.deliver()
+        else:
+            self.transport.drop()
 
     def movePlayHead(self, t):
-        total_duration = 1920 * self.time_sig[0] * self.num_measures 
-        pos = t['bar']*1920*self.time_sig[0] + t['beat']*1920 + t['tick']
-        frac = (pos % total_duration) / total_duration
-        self.play_head.setPos(QtCore.QPointF(frac * self.grid_width, 0))
+        beat_ticks = WHOLE_NOTE / self.time_sig[1]
+        pos = (t['bar']*self.time_sig[0] + t['beat'] + t['tick'] / 1920.) * beat_ticks
+        self.setPlayHead(pos)
+
+    def setPlayHead(self, ticks):
+        """moves the play head, repainting only the strips it left and entered,
+        returns whether it moved"""
+        x = (ticks % self.clip_length) * self.px_per_tick if self.clip_length else 0.
+        if int(x) == int(self.play_head_x):
+            return False
+        old_rect = self.playHeadRect()
+        self.play_head_x = x
+        # an empty rect would make update() repaint the whole scene
+        for rect in (old_rect, self.playHeadRect()):
+            if not rect.isEmpty():
+                self.update(rect)
+        return True
+
+    def startPlayback(self, sample_rate=48000, block_size=256, tempo=120.):
+        """plays the clip as a loop on a render thread; the host pulls each
+        block's events with self.playback.read_block()"""
+        self.loadPendingNotes()
+        self.stopPlayback()
+        self.playback = PlaybackEngine(self.event_stream.freeze(),
+                sample_rate, block_size, tempo)
+        self.published_generation = self.event_stream.generation
+        self.playback.start()
+
+    def stopPlayback(self):
+        if self.playback is not None:
+            self.playback.stop()
+            self.playback = None
+
+    def publishEvents(self):
+        """hands edits made since the last frame to the render thread"""
+        if self.event_stream.generation != self.published_generation:
+            self.playback.stream = self.event_stream.freeze()
+            self.published_generation = self.event_stream.generation
 
     def setTimeSig(self, time_sig):
         try:
            new_time_sig = map(float, time_sig.split('/'))
            if len(new_time_sig)==2:
+               old_end = self.clip_length
                self.time_sig = new_time_sig
 
                self.measure_width = self.full_note_width * self.time_sig[0]/self.time_sig[1]
-               self.max_note_length = self.num_measures * self.time_sig[0]/self.time_sig[1]
+               self.clip_length = int(round(self.num_measures * self.measureTicks()))
                self.grid_width = self.measure_width * self.num_measures
-               self.setGridDiv()
+               self.updateScene(old_end)
         except ValueError:
             pass
 
     def setMeasures(self, measures):
+        self.loadPendingNotes()
         try:
+            old_end = self.clip_length
             self.num_measures = float(measures)
-            self.max_note_length = self.num_measures * self.time_sig[0]/self.time_sig[1]
+            self.clip_length = int(round(self.num_measures * self.measureTicks()))
             self.grid_width = self.measure_width * self.num_measures
-            self.refreshScene()
+            self.updateScene(old_end)
         except:
             pass
 
@@ -350,20 +410,15 @@ class PianoRoll(QtGui.QGraphicsScene):
                 self.value_width = self.full_note_width / float(self.grid_div) if self.grid_div else None
                 self.setQuantize(div)
 
-                self.refreshScene()
+                self.updateScene()
         except ValueError:
             pass
 
     def setQuantize(self, value):
         try:
-            val = map(float, value.split('/'))
-            if len(val) == 1:
-                self.quantize(val[0])
-                self.quantize_val = value
-            elif len(val) == 2:
-                self.quantize(val[0] / val[1])
-                self.quantize_val = value
-        except ValueError:
+            self.quantize(str(value))
+            self.quantize_val = value
+        except (ValueError, ZeroDivisionError):
             pass
 
     # -------------------------------------------------------------------------
@@ -371,7 +426,11 @@ class PianoRoll(QtGui.QGraphicsScene):
 
     def keyPressEvent(self, event):
         QtGui.QGraphicsScene.keyPressEvent(self, event)
-        if event.key() == QtCore.Qt.Key_B:
+        if event.matches(QtGui.QKeySequence.Undo):
+            self.undo()
+        elif event.matches(QtGui.QKeySequence.Redo):
+            self.redo()
+        elif event.key() == QtCore.Qt.Key_B:
             if not self.insert_mode:
                 self.velocity_mode = False
                 self.insert_mode = True
@@ -381,7 +440,7 @@ class PianoRoll(QtGui.QGraphicsScene):
                 if self.place_ghost: self.place_ghost = False
                 self.removeItem(self.ghost_note)
                 self.ghost_note = None
-        elif event.key() == Qt.Key_D:
+        elif event.key() == QtCore.Qt.Key_D:
             if self.velocity_mode:
                 self.velocity_mode = False
             else:
@@ -391,29 +450,30 @@ class PianoRoll(QtGui.QGraphicsScene):
                 self.insert_mode = False
                 self.place_ghost = False
                 self.velocity_mode = True
-        elif event.key() == Qt.Key_A:
-            if all((note.isSelected() for note in self.notes)):
-                for note in self.notes:
-                    note.setSelected(False)
-                self.selected_notes = []
+        elif event.key() == QtCore.Qt.Key_A:
+            if len(self.selected) == len(self.note_store):
+                self.deselectAll()
             else:
-                for note in self.notes:
-                    note.setSelected(True)
-                self.selected_notes = self.notes[:]
-        elif event.key() in (Qt.Key_Delete, Qt.Key_Backspace):
-            self.notes = [note for note in self.notes if note not in self.selected_notes]
-            for note in self.selected_notes:
-                self.removeItem(note)
-                del note
-            self.selected_notes = []
+                self.selectAll()
+        elif event.matches(QtGui.QKeySequence.Copy):
+            self.copySelection()
+        elif event.matches(QtGui.QKeySequence.Cut):
+            self.cutSelection()
+        elif event.matches(QtGui.QKeySequence.Paste):
+            self.paste()
+        elif event.key() in (QtCore.Qt.Key_Delete, QtCore.Qt.Key_Backspace):
+            self.deleteNotes(list(self.selected))
+        elif event.key() == QtCore.Qt.Key_Q:
+            self.quantizeSelection(
+                    fix_ends=bool(event.modifiers() & QtCore.Qt.ShiftModifier))
 
     def mousePressEvent(self, event):
         QtGui.QGraphicsScene.mousePressEvent(self, event)
-        if not (any(key.pressed for key in self.piano_keys) 
-                or any(note.pressed for note in self.notes)):
-            for note in self.selected_notes:
-                note.setSelected(False)
-            self.selected_notes = []
+        self.gesture += 1
+        self.piano_pressed = self.overPiano(event.scenePos())
+        self.pressed_note = self.pressedNoteAt(event.scenePos())
+        if not (self.piano_pressed or self.pressed_note):
+            self.deselectAll()
 
             if event.button() == QtCore.Qt.LeftButton:
                 if self.insert_mode:
@@ -424,23 +484,21 @@ class PianoRoll(QtGui.QGraphicsScene):
                     self.marquee = QtGui.QGraphicsRectItem(self.marquee_rect)
                     self.marquee.setBrush(QtGui.QColor(255, 255, 255, 100))
                     self.addItem(self.marquee)
-        else:
-            for s_note in self.notes:
-                if s_note.pressed and s_note in self.selected_notes:
-                    break
-                elif s_note.pressed and s_note not in self.selected_notes:
-                    for note in self.selected_notes:
-                        note.setSelected(False)
-                    self.selected_notes = [s_note]
-                    break
-            for note in self.selected_notes:
-                if not self.velocity_mode:
-                    note.mousePressEvent(event)
+        elif self.pressed_note:
+            s_note = self.pressed_note
+            if s_note.note_id not in self.selected:
+                self.setSelection((s_note.note_id,))
+            if not self.velocity_mode:
+                self.beginSelectionDrag(s_note)
 
     def mouseMoveEvent(self, event):
         QtGui.QGraphicsScene.mouseMoveEvent(self, event)
         self.mousePos = event.scenePos()
-        if not (any((key.pressed for key in self.piano_keys))):
+        if self.overPiano(self.mousePos) and self.pianoRect().contains(self.mousePos):
+            self.setHoveredKey(self.get_row_num_from_y(self.mousePos.y()))
+        else:
+            self.setHoveredKey(None)
+        if not self.piano_pressed:
             m_pos = event.scenePos()
             if self.insert_mode and self.place_ghost: #placing a note
                 m_width = self.ghost_rect.x() + self.ghost_rect_orig_width
@@ -460,6 +518,8 @@ class PianoRoll(QtGui.QGraphicsScene):
                     except RuntimeError:
                         self.ghost_note = None
                         self.makeGhostNote(m_new_x, m_new_y)
+                    self.ghost_note.setVisible(not (self.overPiano(self.mousePos)
+                        or self.notesAt(self.mousePos)))
 
                 elif self.marquee_select:
                     marquee_orig_pos = event.buttonDownScenePos(QtCore.Qt.LeftButton)
@@ -472,34 +532,21 @@ class PianoRoll(QtGui.QGraphicsScene):
                     elif marquee_orig_pos.x() > m_pos.x() and marquee_orig_pos.y() > m_pos.y():
                         self.marquee_rect.setTopLeft(m_pos)
                     self.marquee.setRect(self.marquee_rect)
-                    self.selected_notes = []
-                    for item in self.collidingItems(self.marquee):
-                        if item in self.notes:
-                            self.selected_notes.append(item)
-
-                    for note in self.notes:
-                        if note in self.selected_notes: note.setSelected(True)
-                        else: note.setSelected(False)
+                    self.setSelection(self.notesInRect(self.marquee_rect))
 
                 elif self.velocity_mode:
-                    if Qt.LeftButton == event.buttons():
-                        for note in self.selected_notes:
-                            note.updateVelocity(event)
+                    if QtCore.Qt.LeftButton == event.buttons():
+                        self.adjustVelocity(self.selected,
+                                event.scenePos().x() - event.lastScenePos().x())
 
-                elif not self.marquee_select: #move selected
+                elif self.selection_drag: #move selected
                     if QtCore.Qt.LeftButton == event.buttons():
-                        x = y = False
-                        if any(note.back.stretch for note in self.selected_notes):
-                            x = True
-                        elif any(note.front.stretch for note in self.selected_notes):
-                            y = True
-                        for note in self.selected_notes:
-                            note.back.stretch = x 
-                            note.front.stretch = y
-                            note.moveEvent(event)
+                        self.dragSelection(event)
 
     def mouseReleaseEvent(self, event):
-        if not (any((key.pressed for key in self.piano_keys)) or any((note.pressed for note in self.notes))):
+        pressed_note, self.pressed_note = self.pressed_note, None
+        piano_pressed, self.piano_pressed = self.piano_pressed, False
+        if not (piano_pressed or pressed_note):
             if event.button() == QtCore.Qt.LeftButton:
                 if self.place_ghost and self.insert_mode:
                     self.place_ghost = False
@@ -512,128 +559,550 @@ class PianoRoll(QtGui.QGraphicsScene):
                     self.marquee_select = False
                     self.removeItem(self.marquee)
         elif not self.marquee_select:
-            for note in self.selected_notes:
-                note.mouseReleaseEvent(event)
-                if self.velocity_mode:
-                    note.setSelected(True)
+            if self.selection_drag:
+                self.endSelectionDrag()
+            if pressed_note:
+                pressed_note.mouseReleaseEvent(event)
+    # -------------------------------------------------------------------------
+    # Selection
+
+    def setSelection(self, note_ids):
+        """replaces the selection, only repainting notes whose state changes"""
+        note_ids = set(note_ids)
+        changed = self.selected ^ note_ids
+        self.selected = note_ids
+        self.showSelection(changed)
+
+    def selectNotes(self, note_ids):
+        changed = set(note_ids) - self.selected
+        self.selected |= changed
+        self.showSelection(changed)
+
+    def deselectNotes(self, note_ids):
+        changed = self.selected.intersection(note_ids)
+        self.selected -= changed
+        self.showSelection(changed)
+
+    def selectAll(self):
+        self.loadPendingNotes()
+        self.selectNotes(self.note_store)
+
+    def deselectAll(self):
+        changed, self.selected = self.selected, set()
+        self.showSelection(changed)
+
+    def showSelection(self, note_ids):
+        """updates the materialized items among note_ids, the others pick
+        their state up when they are bound"""
+        note_items = self.note_items
+        if len(note_ids) > len(note_items):
+            note_ids = [note_id for note_id in note_items if note_id in note_ids]
+        for note_id in note_ids:
+            note = note_items.get(note_id)
+            if note is not None:
+                note.setSelected(note_id in self.selected)
+
+    def adjustVelocity(self, note_ids, offset):
+        delta = int(offset/5)
+        if not delta:
+            return
+        store = self.note_store
+        rows = store.rows
+        velocities = store.velocities
+        # notes already at a bound don't move and aren't recorded
+        note_ids = [note_id for note_id in note_ids
+                if max(1, min(127, velocities[rows[note_id]] + delta)) != velocities[rows[note_id]]]
+        if not note_ids:
+            return
+        edit = NoteEdit.update(store, note_ids, ('velocities',))
+        for note_id in note_ids:
+            row = rows[note_id]
+            velocity = max(1, min(127, velocities[row] + delta))
+            velocities[row] = velocity
+            note = self.note_items.get(note_id)
+            if note is not None:
+                note.showVelocity(velocity)
+        self.history.record(edit.capture(store), coalesce=('velocity', self.gesture))
+        self.event_stream.update_many(note_ids)
+
+    def setVelocityRamp(self, start, start_velocity, end, end_velocity):
+        """sets the velocities of the notes starting between two ticks (only the
+        selected ones, if there is a selection) along a line, in one batch"""
+        if end < start:
+            start, end = end, start
+            start_velocity, end_velocity = end_velocity, start_velocity
+        store = self.note_store
+        rows = store.rows
+        starts = store.starts
+        note_ids = [note_id for note_id in self.note_index.query(start, end)
+                if start <= starts[rows[note_id]] <= end]
+        if self.selected:
+            note_ids = [note_id for note_id in note_ids if note_id in self.selected]
+        if not note_ids:
+            return
+        slope = float(end_velocity - start_velocity) / (end - start) if end > start else 0.
+        velocities = [max(1, min(127, int(round(
+            start_velocity + (starts[rows[note_id]] - start) * slope)))) for note_id in note_ids]
+        edit = NoteEdit.update(store, note_ids, ('velocities',))
+        store.set_many(note_ids, 'velocities', velocities)
+        self.history.record(edit.capture(store))
+        self.event_stream.update_many(note_ids)
+        for note_id, velocity in zip(note_ids, velocities):
+            note = self.note_items.get(note_id)
+            if note is not None:
+                note.showVelocity(velocity)
+
+    def quantizeSelection(self, strength=1., swing=0., humanize=0,
+            fix_starts=True, fix_ends=False):
+        """snaps the selected notes to the quantize grid in one batch, see
+        quantize.quantize for the options"""
+        if not self.selected or not (self.snap_grid or humanize):
+            return
+        note_ids = list(self.selected)
+        store = self.note_store
+        rows = [store.rows[note_id] for note_id in note_ids]
+        starts, lengths = quantize(
+                [store.starts[row] for row in rows],
+                [store.lengths[row] for row in rows],
+                self.snap_grid, strength, swing, humanize, fix_starts, fix_ends)
+        self.fitMeasures(max(starts))
+        max_length = self.clip_length
+        edit = NoteEdit.update(store, note_ids, ('starts', 'lengths'))
+        store.set_many(note_ids, 'starts', starts)
+        store.set_many(note_ids, 'lengths', [min(length, max_length) for length in lengths])
+        self.history.record(edit.capture(store))
+        self.note_index.update_many(note_ids)
+        self.event_stream.update_many(note_ids)
+        for note_id in note_ids:
+            if note_id in self.note_items:
+                self.layoutNoteItem(self.note_items[note_id])
+        self.updateNoteItems()
+
+    # -------------------------------------------------------------------------
+    # Selection Drag
+
+    def beginSelectionDrag(self, anchor):
+        """starts moving (or stretching, if an edge was grabbed) the selection"""
+        if anchor.back.stretch:
+            mode = 'back'
+        elif anchor.front.stretch:
+            mode = 'front'
+        else:
+            mode = 'move'
+        note_ids = list(self.selected)
+        store = self.note_store
+        rows = [store.rows[note_id] for note_id in note_ids]
+        xs = ticks_to_px([store.starts[row] for row in rows], self.px_per_tick, self.piano_width)
+        widths = ticks_to_px([store.lengths[row] for row in rows], self.px_per_tick)
+        rects = [QtCore.QRectF(xs[i], self.get_note_y_pos(store.pitches[row]),
+            widths[i], self.note_height) for i, row in enumerate(rows)]
+        self.selection_drag = SelectionDrag(note_ids, rects, self.noteRect(anchor.note_id), mode)
+        self.addItem(self.selection_drag)
+
+    def dragSelection(self, event):
+        """snaps the grabbed note and offsets the whole group by the same amount,
+        the cost does not depend on how many notes are selected"""
+        drag = self.selection_drag
+        offset = event.scenePos() - event.buttonDownScenePos(QtCore.Qt.LeftButton)
+        left = self.piano_width - drag.bounds.left()
+        right = self.piano_width + self.grid_width - drag.bounds.right()
+        dy = 0
+        if drag.mode == 'move':
+            dx = self.snap(drag.anchor.left() + offset.x()) - drag.anchor.left()
+            dx = max(left, min(right, dx))
+            dy = round(offset.y() / self.note_height) * self.note_height
+            dy = max(self.header_height - drag.bounds.top(),
+                    min(self.header_height + self.piano_height - drag.bounds.bottom(), dy))
+        elif drag.mode == 'back':
+            dx = self.snap(drag.anchor.right() + offset.x()) - drag.anchor.right()
+            dx = max(self.min_note_width - drag.min_width, min(right, dx))
+        else:
+            dx = self.snap(drag.anchor.left() + offset.x()) - drag.anchor.left()
+            dx = max(left, min(drag.min_width - self.min_note_width, dx))
+        drag.setOffset(dx, dy)
+
+    def endSelectionDrag(self):
+        """writes the dragged selection back to the note store in one batch"""
+        drag, self.selection_drag = self.selection_drag, None
+        self.removeItem(drag)
+        if not (drag.dx or drag.dy):
+            return
+        note_ids = drag.note_ids
+        store = self.note_store
+        rows = store.rows
+        ticks = self.get_note_length_from_x(drag.dx)
+        edit = NoteEdit.update(store, note_ids, {
+            'move': ('starts', 'pitches'),
+            'front': ('starts', 'lengths'),
+            'back': ('lengths',)}[drag.mode])
+        if drag.mode == 'move':
+            store.set_many(note_ids, 'starts',
+                    [store.starts[rows[note_id]] + ticks for note_id in note_ids])
+            pitches = int(round(drag.dy / self.note_height))
+            store.set_many(note_ids, 'pitches',
+                    [store.pitches[rows[note_id]] - pitches for note_id in note_ids])
+        else:
+            if drag.mode == 'front':
+                store.set_many(note_ids, 'starts',
+                        [store.starts[rows[note_id]] + ticks for note_id in note_ids])
+                ticks = -ticks
+            store.set_many(note_ids, 'lengths',
+                    [store.lengths[rows[note_id]] + ticks for note_id in note_ids])
+        self.history.record(edit.capture(store))
+        self.note_index.update_many(note_ids)
+        self.event_stream.update_many(note_ids)
+        for note_id in note_ids:
+            if note_id in self.note_items:
+                self.layoutNoteItem(self.note_items[note_id])
+        self.updateNoteItems()
+
+    # -------------------------------------------------------------------------
+    # Clipboard
+
+    def copySelection(self):
+        """puts the selected notes on the clipboard as a NoteStore.pack buffer"""
+        if not self.selected:
+            return
+        self.clipboard = self.note_store.pack(self.selected)
+        mime = QtCore.QMimeData()
+        mime.setData(NOTE_MIME_TYPE, QtCore.QByteArray(self.clipboard))
+        QtGui.QApplication.clipboard().setMimeData(mime)
+
+    def cutSelection(self):
+        self.copySelection()
+        self.deleteNotes(list(self.selected))
+
+    def paste(self):
+        """inserts the clipboard notes in one batch at the mouse, or at the play
+        head when the mouse is off the grid, and selects them"""
+        mime = QtGui.QApplication.clipboard().mimeData()
+        if mime is not None and mime.hasFormat(NOTE_MIME_TYPE):
+            data = bytes(mime.data(NOTE_MIME_TYPE))
+        else:
+            data = self.clipboard
+        if not data:
+            return
+        try:
+            pitches, starts, lengths, velocities = unpack(data)
+        except ValueError:
+            return
+        offset = self.pastePosition()
+        note_ids = self.insertNotes(pitches, array('l', [start + offset for start in starts]),
+                lengths, velocities)
+        self.setSelection(note_ids)
+
+    def pastePosition(self):
+        grid = QtCore.QRectF(self.piano_width, self.header_height,
+                self.grid_width, self.piano_height)
+        if grid.contains(self.mousePos):
+            return self.get_note_start_from_x(self.snap(self.mousePos.x()))
+        return self.get_note_start_from_x(self.piano_width + self.play_head_x)
+
+    # -------------------------------------------------------------------------
+    # Undo/Redo
+
+    def undo(self):
+        self.applyHistory(self.history.undo(self.note_store))
+
+    def redo(self):
+        self.applyHistory(self.history.redo(self.note_store))
+
+    def applyHistory(self, result):
+        """brings the index and the scene items up to date after an undo/redo
+        changed the note store"""
+        if result is None:
+            return
+        edit, (removed, touched) = result
+        columns = edit.columns()
+        if touched and ('starts' in columns or 'lengths' in columns):
+            ## notes can come back past a clip end, or longer than a clip,
+            ## shortened since the edit
+            store = self.note_store
+            rows = [store.rows[note_id] for note_id in touched]
+            self.fitMeasures(max(max(store.starts[row] for row in rows),
+                    max(store.lengths[row] for row in rows) - 1))
+        self.deselectNotes(removed)
+        for note_id in removed:
+            if note_id in self.note_items:
+                self.releaseNoteItem(note_id)
+        self.note_index.remove_many(removed)
+        self.event_stream.remove_many(removed)
+        self.note_index.update_many(touched)
+        self.event_stream.update_many(touched)
+        velocities = 'velocities' in edit.columns()
+        for note_id in touched:
+            note = self.note_items.get(note_id)
+            if note is not None:
+                self.layoutNoteItem(note)
+                if velocities:
+                    note.showVelocity(self.note_store.get(note_id)[3])
+        self.updateNoteItems()
+
     # -------------------------------------------------------------------------
     # Internal Functions
 
-    def drawHeader(self):
-        self.header = QtGui.QGraphicsRectItem(0, 0, self.grid_width, self.header_height)
-        #self.header.setZValue(1.0)
-        self.header.setPos(self.piano_width, 0)
-        self.addItem(self.header)
+    def sceneTiles(self, painter, rect, layer, paint):
+        """draws static decoration through pixmap tiles cached per zoom level
 
-    def drawPiano(self):
-        piano_keys_width = self.piano_width - self.padding
-        labels = ('B','Bb','A','Ab','G','Gb','F','E','Eb','D','Db','C')
-        black_notes = (2,4,6,9,11)
+        paint(painter, rect) renders scene coordinates; tiles are keyed on the
+        painter's scale and self.tile_generation so they survive scrolling and
+        are dropped whenever the grid changes.
+        """
+        transform = painter.worldTransform()
+        scale_x, scale_y = transform.m11(), transform.m22()
+        if scale_x <= 0 or scale_y <= 0 or transform.isRotating():
+            paint(painter, rect)
+            return
+        tile_width = self.tile_size / scale_x
+        tile_height = self.tile_size / scale_y
+        first_col = int(math.floor(rect.left() / tile_width))
+        last_col = int(math.floor(rect.right() / tile_width))
+        first_row = int(math.floor(rect.top() / tile_height))
+        last_row = int(math.floor(rect.bottom() / tile_height))
+        source = QtCore.QRectF(0, 0, self.tile_size, self.tile_size)
+        for col in range(first_col, last_col + 1):
+            for row in range(first_row, last_row + 1):
+                target = QtCore.QRectF(col * tile_width, row * tile_height, tile_width, tile_height)
+                key = '{}:{}:{}:{:.4f}:{:.4f}:{}:{}'.format(layer, id(self),
+                        self.tile_generation, scale_x, scale_y, col, row)
+                pixmap = QtGui.QPixmap()
+                if not QtGui.QPixmapCache.find(key, pixmap):
+                    pixmap = QtGui.QPixmap(self.tile_size, self.tile_size)
+                    pixmap.fill(QtCore.Qt.transparent)
+                    tile_painter = QtGui.QPainter(pixmap)
+                    tile_painter.scale(scale_x, scale_y)
+                    tile_painter.translate(-target.left(), -target.top())
+                    tile_painter.setClipRect(target)
+                    paint(tile_painter, target)
+                    tile_painter.end()
+                    QtGui.QPixmapCache.insert(key, pixmap)
+                painter.drawPixmap(target, pixmap, source)
+
+    def drawBackground(self, painter, rect):
+        QtGui.QGraphicsScene.drawBackground(self, painter, rect)
+        grid_rect = rect.intersected(QtCore.QRectF(self.piano_width, 0,
+                self.grid_width + 1, self.header_height + self.piano_height))
+        if not grid_rect.isEmpty():
+            self.sceneTiles(painter, grid_rect, 'grid', self.paintGrid)
+
+    def drawForeground(self, painter, rect):
+        QtGui.QGraphicsScene.drawForeground(self, painter, rect)
+        piano_rect = rect.intersected(self.pianoRect())
+        if not piano_rect.isEmpty():
+            self.sceneTiles(painter, piano_rect, 'piano', self.paintPiano)
+            if self.hovered_key is not None:
+                painter.fillRect(self.keyRect(self.hovered_key), self.key_hover_brush)
+        if rect.intersects(self.playHeadRect()):
+            x = self.piano_width + self.play_head_x
+            painter.setPen(self.play_head_pen)
+            painter.drawLine(QtCore.QLineF(x, self.header_height, x, self.total_height))
+
+    def pianoRect(self):
+        return QtCore.QRectF(0, self.header_height,
+                self.piano_width - self.padding, self.piano_height)
+
+    def keyRect(self, note_num):
+        width = self.piano_width - self.padding
+        if note_num % self.notes_in_octave in self.black_notes:
+            width /= 1.4
+        return QtCore.QRectF(0, self.get_note_y_pos(note_num), width, self.note_height)
+
+    def visibleRows(self, rect):
+        """midi numbers of the rows intersecting a scene rect, top to bottom"""
+        top = min(self.total_notes - 1, self.get_row_num_from_y(rect.top()))
+        bottom = max(0, self.get_row_num_from_y(rect.bottom()))
+        return range(top, bottom - 1, -1)
+
+    def paintPiano(self, painter, rect):
+        keys_width = self.piano_width - self.padding
         piano_label = QtGui.QFont()
         piano_label.setPointSize(6)
-        self.piano = QtGui.QGraphicsRectItem(0, 0, piano_keys_width, self.piano_height)
-        self.piano.setPos(0, self.header_height)
-        self.addItem(self.piano)
-
-        key = PianoKeyItem(piano_keys_width, self.note_height, self.piano)
-        label = QtGui.QGraphicsSimpleTextItem('C8', key)
-        label.setPos(18, 1)
-        label.setFont(piano_label)
-        key.setBrush(QtGui.QColor(255, 255, 255))
-        for i in range(self.end_octave - self.start_octave, self.start_octave - self.start_octave, -1):
-            for j in range(self.notes_in_octave, 0, -1):
-                if j in black_notes:
-                    key = PianoKeyItem(piano_keys_width/1.4, self.note_height, self.piano)
-                    key.setBrush(QtGui.QColor(0, 0, 0))
-                    key.setZValue(1.0)
-                    key.setPos(0, self.note_height * j + self.octave_height * (i - 1))
-                elif (j - 1) and (j + 1) in black_notes:
-                    key = PianoKeyItem(piano_keys_width, self.note_height * 2, self.piano)
-                    key.setBrush(QtGui.QColor(255, 255, 255))
-                    key.setPos(0, self.note_height * j + self.octave_height * (i - 1) - self.note_height/2.)
-                elif (j - 1) in black_notes:
-                    key = PianoKeyItem(piano_keys_width, self.note_height * 3./2, self.piano)
-                    key.setBrush(QtGui.QColor(255, 255, 255))
-                    key.setPos(0, self.note_height * j + self.octave_height * (i - 1) - self.note_height/2.)
-                elif (j + 1) in black_notes:
-                    key = PianoKeyItem(piano_keys_width, self.note_height * 3./2, self.piano)
-                    key.setBrush(QtGui.QColor(255, 255, 255))
-                    key.setPos(0, self.note_height * j + self.octave_height * (i - 1))
-                if j == 12:
-                    label = QtGui.QGraphicsSimpleTextItem('{}{}'.format(labels[j - 1], self.end_octave - i), key )
-                    label.setPos(18, 6)
-                    label.setFont(piano_label)
-                self.piano_keys.append(key)
-
-    def drawGrid(self):
-        black_notes = [2,4,6,9,11]
-        scale_bar = QtGui.QGraphicsRectItem(0, 0, self.grid_width, self.note_height, self.piano)
-        scale_bar.setPos(self.piano_width, 0)
-        scale_bar.setBrush(QtGui.QColor(100,100,100))
+        painter.setFont(piano_label)
+        key_pen = QtGui.QPen(QtGui.QColor(0,0,0,80))
+        painter.setPen(key_pen)
+        painter.setBrush(QtGui.QColor(255, 255, 255))
+        painter.drawRect(self.pianoRect())
+        rows = self.visibleRows(rect)
+        for note_num in rows:
+            y_pos = self.get_note_y_pos(note_num)
+            if note_num % self.notes_in_octave in self.black_notes:
+                continue
+            # white keys meet at a row edge or halfway down the black key below
+            if (note_num - 1) % self.notes_in_octave in self.black_notes:
+                edge = y_pos + self.note_height * 1.5
+            else:
+                edge = y_pos + self.note_height
+            painter.drawLine(QtCore.QLineF(0, edge, keys_width, edge))
+        painter.setBrush(QtGui.QColor(0, 0, 0))
+        for note_num in rows:
+            y_pos = self.get_note_y_pos(note_num)
+            if note_num % self.notes_in_octave in self.black_notes:
+                painter.drawRect(self.keyRect(note_num))
+            elif note_num % self.notes_in_octave == 0:
+                painter.drawText(QtCore.QPointF(18, y_pos + self.note_height - 1),
+                        'C{}'.format(note_num // self.notes_in_octave + self.start_octave))
+
+    def paintGrid(self, painter, rect):
         clearpen = QtGui.QPen(QtGui.QColor(0,0,0,0))
-        for i in range(self.end_octave - self.start_octave, self.start_octave - self.start_octave, -1):
-            for j in range(self.notes_in_octave, 0, -1):
-                scale_bar = QtGui.QGraphicsRectItem(0, 0, self.grid_width, self.note_height, self.piano)
-                scale_bar.setPos(self.piano_width, self.note_height * j + self.octave_height * (i - 1))
-                scale_bar.setPen(clearpen)
-                if j not in black_notes:
-                    scale_bar.setBrush(QtGui.QColor(120,120,120))
-                else:
-                    scale_bar.setBrush(QtGui.QColor(100,100,100))
+        painter.setPen(clearpen)
+        for note_num in self.visibleRows(rect):
+            row = QtCore.QRectF(self.piano_width, self.get_note_y_pos(note_num),
+                    self.grid_width, self.note_height)
+            if note_num % self.notes_in_octave not in self.black_notes:
+                painter.fillRect(row, QtGui.QColor(120,120,120))
+            else:
+                painter.fillRect(row, QtGui.QColor(100,100,100))
+
+        painter.setPen(QtGui.QPen())
+        painter.setBrush(QtCore.Qt.NoBrush)
+        painter.drawRect(QtCore.QRectF(self.piano_width, 0, self.grid_width, self.header_height))
 
         measure_pen = QtGui.QPen(QtGui.QColor(0, 0, 0, 120), 3)
         half_measure_pen = QtGui.QPen(QtGui.QColor(0, 0, 0, 40), 2)
         line_pen = QtGui.QPen(QtGui.QColor(0, 0, 0, 40))
-        for i in range(0, int(self.num_measures) + 1):
-            measure = QtGui.QGraphicsLineItem(0, 0, 0, self.piano_height + self.header_height - measure_pen.width(), self.header)
-            measure.setPos(self.measure_width * i, 0.5 * measure_pen.width())
-            measure.setPen(measure_pen)
+        divs_per_measure = self.time_sig[0]*self.grid_div/self.time_sig[1]
+        bottom = self.header_height + self.piano_height
+        first = max(0, int((rect.left() - self.piano_width) / self.measure_width))
+        last = min(int(self.num_measures), int((rect.right() - self.piano_width) / self.measure_width))
+        for i in range(first, last + 1):
+            x_pos = self.piano_width + self.measure_width * i
             if i < self.num_measures:
-                number = QtGui.QGraphicsSimpleTextItem('%d' % (i + 1), self.header)
-                number.setPos(self.measure_width * i + 5, 2)
-                number.setBrush(QtCore.Qt.white)
-                for j in self.frange(0, self.time_sig[0]*self.grid_div/self.time_sig[1], 1.):
-                    line = QtGui.QGraphicsLineItem(0, 0, 0, self.piano_height, self.header)
-                    line.setZValue(1.0)
-                    line.setPos(self.measure_width * i + self.value_width * j, self.header_height)
-                    if j == self.time_sig[0]*self.grid_div/self.time_sig[1] / 2.0:
-                        line.setPen(half_measure_pen)
+                for j in self.frange(0, divs_per_measure, 1.):
+                    if j == divs_per_measure / 2.0:
+                        painter.setPen(half_measure_pen)
                     else:
-                        line.setPen(line_pen)
+                        painter.setPen(line_pen)
+                    line_x = x_pos + self.value_width * j
+                    painter.drawLine(QtCore.QLineF(line_x, self.header_height, line_x, bottom))
+                painter.setPen(QtGui.QPen(QtCore.Qt.white))
+                painter.drawText(QtCore.QPointF(x_pos + 5, self.header_height - 5), '%d' % (i + 1))
+            painter.setPen(measure_pen)
+            painter.drawLine(QtCore.QLineF(x_pos, 0.5 * measure_pen.width(),
+                    x_pos, bottom - 0.5 * measure_pen.width()))
+
+    def invalidateTiles(self, layers=QtGui.QGraphicsScene.BackgroundLayer
+            | QtGui.QGraphicsScene.ForegroundLayer):
+        """drops the cached grid/keyboard tiles, called when the grid changes"""
+        self.tile_generation += 1
+        self.invalidate(self.sceneRect(), layers)
+
+    def setHoveredKey(self, note_num):
+        if note_num == self.hovered_key:
+            return
+        for key in (self.hovered_key, note_num):
+            if key is not None:
+                self.invalidate(self.keyRect(key), QtGui.QGraphicsScene.ForegroundLayer)
+        self.hovered_key = note_num
+
+    def playHeadRect(self):
+        """the strip covered by the play head, clipped to the viewport"""
+        x = self.piano_width + self.play_head_x
+        rect = QtCore.QRectF(x - 2, self.header_height, 4,
+                self.total_height - self.header_height)
+        if self.visible_rect is not None:
+            rect = rect.intersected(self.visible_rect)
+        return rect
+
+    def updateScene(self, old_end=None):
+        """applies a grid setting change, touching only what it affects
+
+        old_end: the clip length in ticks before the change; notes past the
+        new end are trimmed through the index
+
+        Unlike refreshScene the work done is bounded by the notes around the
+        clip end plus the items near the viewport, and is recorded in
+        self.last_update_cost: notes looked at and note items re-laid out or
+        released (the grid itself is repainted from the background tiles).
+        """
+        notes = items = 0
+        self.event_stream.set_loop_length(self.clip_length)
+        if old_end is not None:
+            notes, items = self.trimNotes(old_end)
+        self.setSceneRect(0, 0, self.piano_width + self.grid_width,
+                self.header_height + self.piano_height)
+        if self.views():
+            self.views()[0].setSceneRect(self.sceneRect())
+        self.invalidateTiles(QtGui.QGraphicsScene.BackgroundLayer)
+        self.last_update_cost = {'notes': notes, 'items': items}
 
-    def drawPlayHead(self):
-        self.play_head = QtGui.QGraphicsLineItem(self.piano_width, self.header_height, self.piano_width, self.total_height) 
-        self.play_head.setPen(QtGui.QPen(QtGui.QColor(255,255,255,50), 2))
-        self.play_head.setZValue(1.)
-        self.addItem(self.play_head)
+    def trimNotes(self, old_end):
+        """drops notes starting past the clip end and shortens notes longer
+        than the clip, returns how many notes were looked at and how many
+        scene items were re-laid out or released
+
+        Both are recorded as one history entry, so a single undo (with
+        fitMeasures in applyHistory) brings the notes and the measures back.
+        """
+        end = self.clip_length
+        if end >= old_end:
+            return 0, 0
+        candidates = self.note_index.query(end, old_end)
+        store = self.note_store
+        removed = []
+        shortened = []
+        edits = []
+        items = 0
+        for note_id in candidates:
+            note_num, note_start, note_length, note_velocity = store.get(note_id)
+            if note_start >= end:
+                removed.append(note_id)
+            elif note_length > end:
+                shortened.append(note_id)
+        if shortened:
+            edit = NoteEdit.update(store, shortened, ('lengths',))
+            store.set_many(shortened, 'lengths', [end] * len(shortened))
+            edits.append(edit.capture(store))
+            self.note_index.update_many(shortened)
+            self.event_stream.update_many(shortened)
+            for note_id in shortened:
+                if note_id in self.note_items:
+                    self.layoutNoteItem(self.note_items[note_id])
+                    items += 1
+        if removed:
+            edits.append(NoteEdit.delete(store, removed))
+            self.selected.difference_update(removed)
+            for note_id in removed:
+                if note_id in self.note_items:
+                    self.releaseNoteItem(note_id)
+                    items += 1
+            self.note_index.remove_many(removed)
+            self.event_stream.remove_many(removed)
+            store.remove_many(removed)
+        if edits:
+            self.history.record(EditGroup(edits))
+        return len(candidates), items
 
     def refreshScene(self):
-        map(self.removeItem, self.notes)
-        self.selected_notes = []
-        self.piano_keys = []
+        self.loadPendingNotes()
+        for note_id in list(self.note_items):
+            self.releaseNoteItem(note_id)
+        self.selected = set()
         self.clear()
-        self.drawPiano()
-        self.drawHeader()
-        self.drawGrid()
-        self.drawPlayHead()
-        for note in self.notes[:]:
-            if note.note[1] >= (self.num_measures * self.time_sig[0]):
-                self.notes.remove(note)
-            elif note.note[2] > self.max_note_length:
-                new_note = note.note
-                self.notes.remove(note)
-                self.drawNote(new_note[0], new_note[1], self.max_note_length, new_note[3], False)
-        map(self.addItem, self.notes)
+        self.setSceneRect(0, 0, self.piano_width + self.grid_width,
+                self.header_height + self.piano_height)
+        self.invalidateTiles()
+        store = self.note_store
+        end = self.clip_length
+        store.remove_many([note_id for note_id, num, start, length, velocity
+            in store.notes() if start >= end])
+        for note_id, num, start, length, velocity in store.notes():
+            if length > end:
+                store.set(note_id, length=end)
+        self.note_index.rebuild()
+        self.event_stream.rebuild()
+        self.updateNoteItems()
         if self.views():
-            self.views()[0].setSceneRect(self.itemsBoundingRect())
+            self.views()[0].setSceneRect(self.sceneRect())
 
     def clearDrawnItems(self):
+        self.pending_project = None
         self.clear()
-        self.notes = []
-        self.selected_notes = []
-        self.drawPiano()
-        self.drawHeader()
-        self.drawGrid()
+        self.note_store.clear()
+        self.note_index.clear()
+        self.event_stream.clear()
+        self.history.clear()
+        self.note_items = {}
+        self.selected = set()
 
     def makeGhostNote(self, pos_x, pos_y):
         """creates the ghostnote that is placed on the scene before the real one is."""
@@ -651,31 +1120,183 @@ class PianoRoll(QtGui.QGraphicsScene):
     def drawNote(self, note_num, note_start=None, note_length=None, note_velocity=None, add=True):
         """
         note_num: midi number, 0 - 127
-        note_start: 0 - (num_measures * time_sig[0])
-        note_length: 0 - (num_measures  * time_sig[0]/time_sig[1])
+        note_start: in ticks (ticks.PPQ per quarter note)
+        note_length: in ticks, at most the clip length
         note_velocity: 0 - 127
         """
+        self.loadPendingNotes()
+
+        self.fitMeasures(note_start)
+        if note_length > self.clip_length:
+            note_length = self.clip_length
+        note_id = self.note_store.add(note_num, note_start, note_length, note_velocity)
+        self.history.record(NoteEdit.insert(self.note_store, (note_id,)))
+        self.note_index.add(note_id)
+        self.event_stream.add(note_id)
+        if add and self.isNoteVisible(note_id):
+            self.addNoteItem(note_id)
+        return note_id
+
+    def insertNotes(self, pitches, starts, lengths, velocities):
+        """adds a batch of notes as one model update and one undo entry,
+        growing the clip once if they run past its end"""
+        self.loadPendingNotes()
+        if not len(pitches):
+            return []
+        self.fitMeasures(max(starts))
+        max_length = self.clip_length
+        lengths = [min(length, max_length) for length in lengths]
+        note_ids = self.note_store.add_many(pitches, starts, lengths, velocities)
+        self.history.record(NoteEdit.insert(self.note_store, note_ids))
+        self.note_index.add_many(note_ids)
+        self.event_stream.add_many(note_ids)
+        self.updateNoteItems()
+        return note_ids
+
+    def loadNotes(self, pitches, starts, lengths, velocities):
+        """replaces the clip with a batch of notes given as parallel columns
+
+        The measure count is worked out once, the scene is sized once and the
+        notes are stored and indexed in one pass. Loading clears the undo
+        history rather than being undoable itself.
+        """
+        self.pending_project = None
+        for note_id in list(self.note_items):
+            self.releaseNoteItem(note_id)
+        self.selected = set()
+        self.note_store.clear()
+        self.history.clear()
+        if len(pitches):
+            self.fitMeasures(max(starts))
+        max_length = self.clip_length
+        if len(lengths) and max(lengths) > max_length:
+            lengths = [min(length, max_length) for length in lengths]
+        note_ids = self.note_store.add_many(pitches, starts, lengths, velocities)
+        self.note_index.rebuild()
+        self.event_stream.rebuild()
+        self.updateNoteItems()
+        return note_ids
+
+    def importMidi(self, path):
+        """replaces the clip with the notes of a .mid file"""
+        return self.loadNotes(*read_columns(path))
+
+    def exportMidi(self, path):
+        self.loadPendingNotes()
+        write_notes(path, self.note_store, self.time_sig)
+
+    def saveProject(self, project):
+        """puts the clip settings and notes in a project.Project, only
+        columns that changed get written on the next save"""
+        self.loadPendingNotes()
+        store = self.note_store
+        project.set('piano.settings', array('d',
+            [self.time_sig[0], self.time_sig[1], self.num_measures]))
+        project.set('notes.pitches', store.pitches)
+        project.set('notes.starts', store.starts)
+        project.set('notes.lengths', store.lengths)
+        project.set('notes.velocities', store.velocities)
+
+    def loadProject(self, project):
+        """reads the clip settings; the note columns stay in the file until
+        the notes are first drawn, played, edited or saved"""
+        self.pending_project = None
+        settings = project.get('piano.settings')
+        if settings is not None:
+            self.setTimeSig('{:g}/{:g}'.format(settings[0], settings[1]))
+            self.setMeasures(settings[2])
+        if 'notes.pitches' in project:
+            self.pending_project = project
+
+    def loadPendingNotes(self):
+        """pages in the notes of the project loadProject last opened"""
+        project, self.pending_project = self.pending_project, None
+        if project is not None:
+            self.loadNotes(project.get('notes.pitches'), project.get('notes.starts'),
+                    project.get('notes.lengths'), project.get('notes.velocities'))
+
+    def fitMeasures(self, note_start):
+        """grows the clip, in a single step, so a note starting at note_start fits"""
+        if note_start < self.clip_length:
+            return
+        self.setMeasures(int(note_start // self.measureTicks()) + 1)
+        self.measureupdate.emit(int(self.num_measures))
+
+    def deleteNotes(self, note_ids):
+        """removes a batch of notes as one model update and one undo entry"""
+        if not note_ids:
+            return
+        self.deselectNotes(note_ids)
+        self.history.record(NoteEdit.delete(self.note_store, note_ids))
+        self.note_index.remove_many(note_ids)
+        self.event_stream.remove_many(note_ids)
+        self.note_store.remove_many(note_ids)
+        for note_id in note_ids:
+            if note_id in self.note_items:
+                self.releaseNoteItem(note_id)
 
-        info = [note_num, note_start, note_length, note_velocity]
-
-        if not note_start % (self.num_measures * self.time_sig[0]) == note_start:
-            while not note_start % (self.num_measures * self.time_sig[0]) == note_start:
-                self.setMeasures(self.num_measures+1)
-            self.measureupdate.emit(self.num_measures)
-            self.refreshScene()
-
-        x_start = self.get_note_x_start(note_start)
-        if note_length > self.max_note_length:
-            note_length = self.max_note_length + 0.25
-        x_length = self.get_note_x_length(note_length)
-        y_pos = self.get_note_y_pos(note_num)
-
-        note = NoteItem(self.note_height, x_length, info)
-        note.setPos(x_start, y_pos)
-
-        self.notes.append(note)
-        if add:
-            self.addItem(note)
+    # -------------------------------------------------------------------------
+    # Note Item Virtualization
+
+    def setVisibleRect(self, rect):
+        """called by the view whenever the part of the scene on screen changes"""
+        self.visible_rect = rect
+        self.updateNoteItems()
+        self.viewChanged.emit()
+
+    def marginRect(self):
+        m = self.visible_margin
+        return self.visible_rect.adjusted(-m, -m, m, m)
+
+    def noteRect(self, note_id):
+        note_num, note_start, note_length, note_velocity = self.note_store.get(note_id)
+        return QtCore.QRectF(self.get_note_x_start(note_start), self.get_note_y_pos(note_num),
+                self.get_note_x_length(note_length), self.note_height)
+
+    def isNoteVisible(self, note_id):
+        return self.visible_rect is None or self.marginRect().intersects(self.noteRect(note_id))
+
+    def updateNoteItems(self):
+        """materializes items for the notes near the viewport and recycles the rest,
+        the pressed note keeps its item"""
+        self.loadPendingNotes()
+        if self.visible_rect is None:
+            wanted = set(self.note_store)
+        else:
+            wanted = self.notesInRect(self.marginRect())
+        for note_id in [note_id for note_id in self.note_items if note_id not in wanted]:
+            if not self.note_items[note_id].pressed:
+                self.releaseNoteItem(note_id)
+        for note_id in wanted:
+            if note_id not in self.note_items:
+                self.addNoteItem(note_id)
+
+    def addNoteItem(self, note_id):
+        """gives a note that is already in the note store a scene item, reusing
+        a pooled item when there is one"""
+        rect = self.noteRect(note_id)
+        if self.item_pool:
+            note = self.item_pool.pop()
+        else:
+            note = NoteItem(self.note_height, rect.width(), note_id)
+        self.addItem(note)
+        note.bind(note_id, rect.x(), rect.y(), rect.width(), note_id in self.selected)
+        note.showVelocity(self.note_store.velocities[self.note_store.rows[note_id]])
+        self.note_items[note_id] = note
+        return note
+
+    def layoutNoteItem(self, note):
+        """moves and resizes an item to match its note, keeping its state"""
+        rect = self.noteRect(note.note_id)
+        note.setRect(0, 0, rect.width(), self.note_height)
+        note.back.setPos(rect.width() - note.back.rect().width(), 0)
+        note.setPos(rect.x(), rect.y())
+
+    def releaseNoteItem(self, note_id):
+        """takes a note's item off the scene and returns it to the pool"""
+        note = self.note_items.pop(note_id)
+        self.removeItem(note)
+        self.item_pool.append(note)
 
     # -------------------------------------------------------------------------
     # Helper Functions
@@ -686,12 +1307,13 @@ class PianoRoll(QtGui.QGraphicsScene):
             x += t
 
     def quantize(self, value):
-        self.snap_value = float(self.full_note_width) * value if value else None
+        """value: the grid as a fraction of a whole note, e.g. '1/9' or 0.125"""
+        self.snap_grid = grid_ticks(value)
 
     def snap(self, pos_x, pos_y = None):
-        if self.snap_value:
-            pos_x = int(round((pos_x - self.piano_width) / self.snap_value)) \
-                    * self.snap_value + self.piano_width
+        if self.snap_grid:
+            pos_x = self.get_note_x_start(
+                    snap_tick(self.get_note_start_from_x(pos_x), self.snap_grid))
         if pos_y:
             pos_y = int((pos_y - self.header_height) / self.note_height) \
                     * self.note_height + self.header_height
@@ -723,20 +1345,20 @@ class PianoRoll(QtGui.QGraphicsScene):
             pos.setY(self.header_height + self.padding)
         return pos
 
-    def get_note_start_from_x(self, note_x):
-        return (note_x - self.piano_width) / (self.grid_width / self.num_measures / self.time_sig[0])
+    def measureTicks(self):
+        return self.time_sig[0] * WHOLE_NOTE / self.time_sig[1]
 
+    def get_note_start_from_x(self, note_x):
+        return int(round((note_x - self.piano_width) / self.px_per_tick))
 
     def get_note_x_start(self, note_start):
-        return self.piano_width + \
-                (self.grid_width / self.num_measures / self.time_sig[0]) * note_start
+        return self.piano_width + self.px_per_tick * note_start
 
     def get_note_x_length(self, note_length):
-        return float(self.time_sig[1]) / self.time_sig[0] * note_length * self.grid_width / self.num_measures
+        return self.px_per_tick * note_length
 
     def get_note_length_from_x(self, note_x):
-        return float(self.time_sig[0]) / self.time_sig[1] * self.num_measures / self.grid_width \
-                * note_x
+        return int(round(note_x / self.px_per_tick))
 
 
     def get_note_y_pos(self, note_num):
@@ -745,6 +1367,38 @@ class PianoRoll(QtGui.QGraphicsScene):
     def get_note_num_from_y(self, note_y_pos):
         return -(((note_y_pos - self.header_height) / self.note_height) - self.total_notes + 1)
 
+    def get_row_num_from_y(self, y_pos):
+        """midi number of the row containing y_pos, unlike get_note_num_from_y
+        this works for any point inside a row, not just its top edge"""
+        return self.total_notes - 1 - int(math.floor((y_pos - self.header_height) / self.note_height))
+
+    # -------------------------------------------------------------------------
+    # Note Lookup
+
+    def overPiano(self, pos):
+        return pos.x() < self.piano_width
+
+    def notesAt(self, pos):
+        """ids of the notes under a scene position"""
+        return self.note_index.at(self.get_row_num_from_y(pos.y()),
+                self.get_note_start_from_x(pos.x()))
+
+    def notesInRect(self, rect):
+        """ids of the notes intersecting a scene rect"""
+        return self.note_index.query(
+                self.get_note_start_from_x(rect.left()),
+                self.get_note_start_from_x(rect.right()),
+                self.get_row_num_from_y(rect.bottom()),
+                self.get_row_num_from_y(rect.top()))
+
+    def pressedNoteAt(self, pos):
+        """the note item that took the last mouse press, looked up through the index"""
+        for note_id in self.notesAt(pos):
+            note = self.note_items.get(note_id)
+            if note is not None and note.pressed:
+                return note
+        return None
+
 
 class PianoRollView(QtGui.QGraphicsView):
     def __init__(self, time_sig = '4/4', num_measures = 4, quantize_val = '1/8'):
@@ -761,16 +1415,113 @@ class PianoRollView(QtGui.QGraphicsView):
         self.o_transform = self.transform()
         self.zoom_x = 1
         self.zoom_y = 1
+        self.updateVisibleRect()
+
+    def updateVisibleRect(self):
+        self.piano.setVisibleRect(self.mapToScene(self.viewport().rect()).boundingRect())
+
+    def scrollContentsBy(self, dx, dy):
+        QtGui.QGraphicsView.scrollContentsBy(self, dx, dy)
+        self.updateVisibleRect()
+
+    def resizeEvent(self, event):
+        QtGui.QGraphicsView.resizeEvent(self, event)
+        self.updateVisibleRect()
 
     def setZoomX(self, scale_x):
         self.setTransform(self.o_transform)
         self.zoom_x = 1 + scale_x / float(99) * 2
         self.scale(self.zoom_x, self.zoom_y)
+        self.updateVisibleRect()
 
     def setZoomY(self, scale_y):
         self.setTransform(self.o_transform)
         self.zoom_y = 1 + scale_y / float(99)
         self.scale(self.zoom_x, self.zoom_y)
+        self.updateVisibleRect()
+
+class VelocityLane(QtGui.QWidget):
+    '''the velocities of the notes on screen, under the piano roll
+
+    Stems are drawn in one painter call straight from the note columns, and
+    dragging a line sets every note it spans with one PianoRoll.setVelocityRamp.
+    '''
+    def __init__(self, view):
+        QtGui.QWidget.__init__(self)
+        self.view = view
+        self.piano = view.piano
+        self.setFixedHeight(80)
+        self.margin = 4
+        self.click_width = 3 # px either side of a click that still hits a note
+        self.ramp = None # [press point, mouse point] while drawing a line
+        self.stem_pen = QtGui.QPen(QtGui.QColor(200, 60, 60), 2)
+        self.ramp_pen = QtGui.QPen(QtGui.QColor(255, 255, 255, 150), 1)
+        self.piano.notesChanged.connect(self.update)
+        self.piano.viewChanged.connect(self.update)
+
+    def sceneMapping(self):
+        """scale and offset mapping scene x to lane x"""
+        transform = self.view.viewportTransform()
+        origin = self.mapFromGlobal(self.view.viewport().mapToGlobal(QtCore.QPoint(0, 0)))
+        return transform.m11(), transform.dx() + origin.x()
+
+    def velocityY(self, velocity):
+        return self.height() - self.margin - velocity * (self.height() - 2 * self.margin) / 127.
+
+    def yVelocity(self, y):
+        return (self.height() - self.margin - y) * 127. / (self.height() - 2 * self.margin)
+
+    def tickAt(self, x):
+        scale, offset = self.sceneMapping()
+        return self.piano.get_note_start_from_x((x - offset) / scale)
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), QtGui.QColor(50, 50, 50))
+        piano = self.piano
+        scale, offset = self.sceneMapping()
+        start = self.tickAt(0)
+        end = self.tickAt(self.width())
+        store = piano.note_store
+        rows = store.rows
+        starts = store.starts
+        velocities = store.velocities
+        bottom = self.height() - self.margin
+        x0 = scale * piano.piano_width + offset
+        px = scale * piano.px_per_tick
+        lines = []
+        for note_id in piano.note_index.query(start, end):
+            row = rows[note_id]
+            x = x0 + starts[row] * px
+            lines.append(QtCore.QLineF(x, bottom, x, self.velocityY(velocities[row])))
+        painter.setPen(self.stem_pen)
+        painter.drawLines(lines)
+        if self.ramp is not None:
+            painter.setPen(self.ramp_pen)
+            painter.drawLine(self.ramp[0], self.ramp[1])
+        painter.end()
+
+    def mousePressEvent(self, event):
+        self.ramp = [event.pos(), event.pos()]
+        self.update()
+
+    def mouseMoveEvent(self, event):
+        if self.ramp is not None:
+            self.ramp[1] = event.pos()
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if self.ramp is None:
+            return
+        first, last = sorted(self.ramp, key=lambda point: point.x())
+        self.ramp = None
+        left, right = first.x(), last.x()
+        if right - left < self.click_width:
+            left -= self.click_width
+            right += self.click_width
+        self.piano.setVelocityRamp(self.tickAt(left), self.yVelocity(first.y()),
+                self.tickAt(right), self.yVelocity(last.y()))
+        self.update()
 
 class ModeIndicator(QtGui.QWidget):
     def __init__(self):
@@ -812,6 +1563,7 @@ class MainWindow(QtGui.QWidget):
                 quantize_val = '1/8')
 
         self.piano = self.view.piano
+        self.velocityLane = VelocityLane(self.view)
 
         self.timeSigLabel = QtGui.QLabel('time signature')
         self.timeSigLabel.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignCenter)
@@ -883,10 +1635,14 @@ class MainWindow(QtGui.QWidget):
         self.viewBox = QtGui.QHBoxLayout()
         self.viewBox.addWidget(self.vSlider)
         self.viewBox.addWidget(self.view)
+        self.laneBox = QtGui.QHBoxLayout()
+        self.laneBox.addSpacing(self.vSlider.sizeHint().width())
+        self.laneBox.addWidget(self.velocityLane)
         self.layout = QtGui.QVBoxLayout()
 
         self.layout.addLayout(self.hBox)
         self.layout.addLayout(self.viewBox)
+        self.layout.addLayout(self.laneBox)
 
         self.setLayout(self.layout)
         self.view.setFocus()
@@ -900,9 +1656,9 @@ if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
     main = MainWindow()
     main.show()
-    main.piano.drawNote(71, 0, 0.50, 20)
-    main.piano.drawNote(73, 1, 0.50, 20)
-    main.piano.drawNote(75, 2, 0.50, 20)
-    main.piano.drawNote(77, 3, 0.50, 20)
-    main.piano.drawNote(79, 4, 0.50, 20)
+    main.piano.drawNote(71, 0 * PPQ, 2 * PPQ, 20)
+    main.piano.drawNote(73, 1 * PPQ, 2 * PPQ, 20)
+    main.piano.drawNote(75, 2 * PPQ, 2 * PPQ, 20)
+    main.piano.drawNote(77, 3 * PPQ, 2 * PPQ, 20)
+    main.piano.drawNote(79, 4 * PPQ, 2 * PPQ, 20)
     sys.exit(app.exec_())
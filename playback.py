@@ -0,0 +1,237 @@
+"""
+Block-based MIDI playback of an EventStream
+
+A PlaybackEngine renders the events of each audio block on its own thread,
+a few blocks ahead of the host, into a preallocated single-producer /
+single-consumer ring. The host only reads the ring, so it never takes a lock
+or waits on the GUI thread. The GUI publishes edits by swapping in a frozen
+copy of the stream (EventStream.freeze), which the engine picks up at the
+next block.
+"""
+import threading
+import time
+from array import array
+
+from ticks import PPQ
+
+class EventRing(object):
+    '''fixed size ring of (frame, status, pitch, velocity) events for one
+    writer thread and one reader thread'''
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.frames = array('l', [0]) * capacity
+        self.statuses = array('B', [0]) * capacity
+        self.pitches = array('B', [0]) * capacity
+        self.velocities = array('B', [0]) * capacity
+        ## only the writer moves written, only the reader moves read
+        self.written = 0
+        self.read = 0
+
+    def __len__(self):
+        return self.written - self.read
+
+    def push(self, frame, status, pitch, velocity):
+        """writer side, returns False when the ring is full"""
+        if self.written - self.read >= self.capacity:
+            return False
+        i = self.written % self.capacity
+        self.frames[i] = frame
+        self.statuses[i] = status
+        self.pitches[i] = pitch
+        self.velocities[i] = velocity
+        self.written += 1 # publishes the slot
+        return True
+
+    def peek_frame(self):
+        """reader side, frame of the oldest event or None"""
+        if self.written == self.read:
+            return None
+        return self.frames[self.read % self.capacity]
+
+    def pop(self):
+        """reader side, the oldest event or None"""
+        if self.written == self.read:
+            return None
+        i = self.read % self.capacity
+        event = (self.frames[i], self.statuses[i], self.pitches[i], self.velocities[i])
+        self.read += 1
+        return event
+
+class PlaybackEngine(object):
+    '''renders an EventStream to sample accurate MIDI events block by block'''
+    def __init__(self, stream, sample_rate=48000, block_size=256, tempo=120.,
+            lookahead=4, capacity=4096):
+        self.stream = stream # swap in a new frozen stream to publish edits
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.lookahead = lookahead # blocks rendered ahead of the host
+        self.ring = EventRing(capacity)
+        self.set_tempo(tempo)
+        self.thread = None
+        self.running = False
+        self.render_frame = 0 # start of the next block to render
+        self.host_frame = 0 # end of the last block the host read
+        self.reset_stats()
+
+    def set_tempo(self, tempo):
+        self.tempo = float(tempo)
+        self.samples_per_tick = self.sample_rate * 60. / (self.tempo * PPQ)
+
+    def block_period(self):
+        return float(self.block_size) / self.sample_rate
+
+    def ticks(self):
+        """playback position in ticks, as heard by the host"""
+        return self.host_frame / self.samples_per_tick
+
+    def tick_frame(self, tick):
+        """the frame an event on a tick is played at"""
+        return int(tick * self.samples_per_tick)
+
+    def first_tick(self, frame):
+        """the first tick played at or after a frame, blocks [frame, end) hold
+        exactly the ticks first_tick(frame) .. first_tick(end) - 1"""
+        tick = int(-(-frame // self.samples_per_tick))
+        ## step over float rounding so tick_frame agrees with the bounds
+        while self.tick_frame(tick) < frame:
+            tick += 1
+        while tick > 0 and self.tick_frame(tick - 1) >= frame:
+            tick -= 1
+        return tick
+
+    # -------------------------------------------------------------------------
+    # Render thread
+
+    def start(self, frame=0):
+        if self.running:
+            return
+        self.ring = EventRing(self.ring.capacity)
+        self.render_frame = self.host_frame = frame
+        self.render_ahead()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='playback')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        period = self.block_period()
+        while self.running:
+            self.render_ahead()
+            slept = time.time()
+            time.sleep(period / 2)
+            self.note_wake(time.time() - slept - period / 2)
+
+    def render_ahead(self):
+        while self.render_frame < self.host_frame + self.lookahead * self.block_size:
+            self.render_block()
+
+    def render_block(self):
+        """queues the events of the block starting at render_frame"""
+        stream = self.stream
+        frame = self.render_frame
+        start = self.first_tick(frame)
+        end = self.first_tick(frame + self.block_size)
+        loop = stream.loop_length
+        if loop > 0:
+            base = start - start % loop
+            lo, hi, lo2, hi2 = stream.query(start, end)
+            self.queue_events(stream, lo, hi, base, frame)
+            self.queue_events(stream, lo2, hi2, base + loop, frame)
+        self.render_frame = frame + self.block_size
+        self.stats['blocks_rendered'] += 1
+
+    def queue_events(self, stream, lo, hi, base, frame):
+        keys = stream.keys
+        pitches = stream.pitches
+        velocities = stream.velocities
+        tick_frame = self.tick_frame
+        last = frame + self.block_size - 1
+        ring = self.ring
+        for i in range(lo, hi):
+            key = keys[i]
+            event_frame = tick_frame((key >> 1) + base)
+            if not frame <= event_frame <= last:
+                ## can't happen with the tick windows of render_block, but an
+                ## event moved into this block would play at the wrong time
+                self.stats['late_events'] += 1
+                event_frame = min(max(event_frame, frame), last)
+            if not ring.push(event_frame, 0x90 if key & 1 else 0x80,
+                    pitches[i], velocities[i]):
+                self.stats['overflows'] += 1
+
+    # -------------------------------------------------------------------------
+    # Host side
+
+    def read_block(self, frame=None):
+        """events of the host block starting at frame (default: right after the
+        last one read) as (offset in the block, status, pitch, velocity)"""
+        if frame is None:
+            frame = self.host_frame
+        end = frame + self.block_size
+        stats = self.stats
+        lead = self.render_frame - frame
+        if lead < self.block_size:
+            stats['underruns'] += 1
+        stats['blocks_read'] += 1
+        stats['lead_total'] += lead
+        stats['lead_min'] = lead if stats['lead_min'] is None else min(stats['lead_min'], lead)
+        events = []
+        ring = self.ring
+        while True:
+            event_frame = ring.peek_frame()
+            if event_frame is None or event_frame >= end:
+                break
+            event_frame, status, pitch, velocity = ring.pop()
+            if event_frame < frame:
+                stats['late_events'] += 1
+            events.append((max(0, event_frame - frame), status, pitch, velocity))
+        stats['events'] += len(events)
+        self.host_frame = end
+        return events
+
+    # -------------------------------------------------------------------------
+    # Statistics
+
+    def note_wake(self, late):
+        stats = self.stats
+        stats['wakes'] += 1
+        stats['wake_late_total'] += late
+        stats['wake_late_max'] = max(stats['wake_late_max'], late)
+
+    def reset_stats(self):
+        self.stats = {
+            'blocks_rendered': 0,
+            'blocks_read': 0,
+            'events': 0,
+            'overflows': 0, # events dropped on a full ring
+            'underruns': 0, # blocks read before they were fully rendered
+            'late_events': 0, # events delivered or queued away from their frame
+            'lead_total': 0,
+            'lead_min': None,
+            'wakes': 0,
+            'wake_late_total': 0.,
+            'wake_late_max': 0.,
+            }
+
+    def latency(self):
+        """rendered lead over the host in ms, (mean, min)"""
+        stats = self.stats
+        if not stats['blocks_read']:
+            return 0., 0.
+        scale = 1000. / self.sample_rate
+        return (scale * stats['lead_total'] / stats['blocks_read'],
+                scale * stats['lead_min'])
+
+    def jitter(self):
+        """how late the render thread wakes up in ms, (mean, max)"""
+        stats = self.stats
+        if not stats['wakes']:
+            return 0., 0.
+        return (1000. * stats['wake_late_total'] / stats['wakes'],
+                1000. * stats['wake_late_max'])
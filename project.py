@@ -0,0 +1,169 @@
+"""
+Binary project file: named fixed-width columns behind a section table
+
+    header   magic 'SQPJ', format version, number of table slots
+    table    one entry per slot: name, typecode, item count, offset, capacity
+    sections the column data, little endian, each in a slot of `capacity` bytes
+
+Opening a project only reads the header and the table from a memory map;
+a column is paged in the first time it is asked for. Saving rewrites only
+the columns that changed since the last save, in place when they still fit
+in their slot, appended at the end of the file otherwise.
+"""
+import mmap
+import os
+import struct
+from array import array
+
+from note_store import to_bytes, from_bytes
+
+MAGIC = b'SQPJ'
+VERSION = 1
+HEADER = struct.Struct('<4sHH')
+NAME_SIZE = 24
+ENTRY = struct.Struct('<{}scxxxIQQ'.format(NAME_SIZE))
+SLOTS = 64
+TYPECODES = {'l': 'i', 'i': 'i', 'd': 'd', 'B': 'B'} # column -> stored typecode
+
+class Project(object):
+    '''a project file, opened lazily and saved incrementally'''
+    def __init__(self, path):
+        self.path = path
+        self.entries = {} # name -> [typecode, count, offset, capacity, slot]
+        self.columns = {} # name -> array, columns paged in or set
+        self.dirty = set()
+        self.file = None
+        self.data = None
+        if os.path.exists(path):
+            self.open()
+
+    def open(self):
+        self.file = open(self.path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, slots = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('not a project file')
+        if version != VERSION or slots != SLOTS:
+            raise ValueError('unsupported project version {}'.format(version))
+        self.entries = {}
+        for slot in range(slots):
+            name, typecode, count, offset, capacity = ENTRY.unpack_from(
+                    self.data, HEADER.size + slot * ENTRY.size)
+            name = name.rstrip(b'\0').decode('utf-8')
+            if name:
+                self.entries[name] = [typecode.decode('ascii'), count, offset, capacity, slot]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.file.close()
+            self.data = self.file = None
+
+    def __contains__(self, name):
+        return name in self.columns or name in self.entries
+
+    def names(self):
+        return sorted(set(self.entries) | set(self.columns))
+
+    # -------------------------------------------------------------------------
+    # Columns
+
+    def get(self, name, default=None):
+        """a column as an array, read from the file on first access"""
+        column = self.columns.get(name)
+        if column is not None:
+            return column
+        entry = self.entries.get(name)
+        if entry is None:
+            return default
+        typecode, count, offset, capacity, slot = entry
+        column = array(typecode)
+        from_bytes(column, self.data[offset:offset + count * column.itemsize])
+        self.columns[name] = column
+        return column
+
+    def set(self, name, column):
+        """replaces a column; it is written on the next save if it changed"""
+        column = array(TYPECODES[column.typecode], column)
+        if len(name.encode('utf-8')) > NAME_SIZE:
+            raise ValueError('column name too long: {}'.format(name))
+        if name in self and self.get(name) == column:
+            return
+        self.columns[name] = column
+        self.dirty.add(name)
+
+    def set_text(self, name, strings):
+        """stores a list of strings as one column of NUL terminated utf-8"""
+        self.set(name, array('B', b''.join(string.encode('utf-8') + b'\0'
+            for string in strings)))
+
+    def get_text(self, name):
+        column = self.get(name)
+        if column is None:
+            return []
+        return [string.decode('utf-8') for string in to_bytes(column).split(b'\0')[:-1]]
+
+    # -------------------------------------------------------------------------
+    # Saving
+
+    def save(self):
+        """writes the changed columns, or the whole file if it doesn't exist"""
+        if not self.dirty and os.path.exists(self.path):
+            return
+        self.close()
+        if not os.path.exists(self.path):
+            self.write_all(self.path)
+        else:
+            with open(self.path, 'r+b') as f:
+                for name in sorted(self.dirty):
+                    self.write_section(f, name)
+        self.dirty = set()
+        self.open()
+
+    def write_section(self, f, name):
+        column = self.columns[name]
+        data = to_bytes(column)
+        entry = self.entries.get(name)
+        if entry is None:
+            used = set(entry[4] for entry in self.entries.values())
+            free = [slot for slot in range(SLOTS) if slot not in used]
+            if not free:
+                raise ValueError('project has no free section slots')
+            entry = self.entries[name] = [column.typecode, 0, 0, 0, free[0]]
+        if len(data) > entry[3] or not entry[2]:
+            ## doesn't fit its slot any more, move it to the end with room to grow
+            f.seek(0, os.SEEK_END)
+            entry[2] = f.tell()
+            entry[3] = max(64, len(data) + len(data) // 2)
+            f.truncate(entry[2] + entry[3])
+        f.seek(entry[2])
+        f.write(data)
+        entry[0] = column.typecode
+        entry[1] = len(column)
+        f.seek(HEADER.size + entry[4] * ENTRY.size)
+        f.write(ENTRY.pack(name.encode('utf-8'), entry[0].encode('ascii'),
+            entry[1], entry[2], entry[3]))
+
+    def write_all(self, path):
+        """writes every column to a new, compact file"""
+        for name in self.names():
+            self.get(name)
+        self.entries = {}
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, SLOTS))
+            f.write(b'\0' * (SLOTS * ENTRY.size))
+            for name in self.names():
+                self.write_section(f, name)
+
+    def compact(self):
+        """rewrites the file without the space left behind by moved sections"""
+        for name in self.names():
+            self.get(name)
+        self.close()
+        temp_path = self.path + '.tmp'
+        self.write_all(temp_path)
+        if os.name == 'nt':
+            os.remove(self.path)
+        os.rename(temp_path, self.path)
+        self.dirty = set()
+        self.open()
@@ -0,0 +1,63 @@
+"""
+Batch quantize, swing and humanize of note columns
+
+Works on whole tick columns at once (see ticks.py) so a selection of
+thousands of notes is re-quantized in one call. Grid steps are exact
+fractions of a tick, which keeps tuplet grids like 1/9 or 1/15 from drifting.
+"""
+import random
+from array import array
+
+def grid_lines(ticks, grid, swing=0.):
+    """nearest grid line for each tick; odd lines are pushed late by swing
+    (a fraction of one grid step, 0 - 1)"""
+    num, den = grid.numerator, grid.denominator
+    num2, den2 = 2 * num, 2 * den
+    lines = [(2 * tick * den + num) // num2 for tick in ticks]
+    if not swing:
+        return array('l', [(line * num2 + den) // den2 for line in lines])
+    late = int(round(float(grid) * swing))
+    return array('l', [(line * num2 + den) // den2 + late * (line & 1) for line in lines])
+
+def pull(ticks, targets, strength=1.):
+    """moves each tick towards its target by strength (0 - 1)"""
+    if strength >= 1.:
+        return array('l', targets)
+    return array('l', [tick + int(round((target - tick) * strength))
+        for tick, target in zip(ticks, targets)])
+
+def jitter(ticks, amount, seed=None):
+    """adds a uniform random offset of up to +-amount ticks"""
+    if not amount:
+        return array('l', ticks)
+    rand = random.Random(seed).random
+    width = 2 * amount + 1
+    return array('l', [tick + int(rand() * width) - amount for tick in ticks])
+
+def quantize(starts, lengths, grid, strength=1., swing=0., humanize=0,
+        fix_starts=True, fix_ends=False, seed=None):
+    """quantizes a batch of notes given as tick columns
+
+    grid: the step in ticks (a Fraction, see ticks.grid_ticks), None to only
+    humanize
+    strength: how far notes move towards the grid, 0 - 1
+    swing: delay of every other grid line, as a fraction of a step
+    humanize: random offset in ticks applied to the starts afterwards
+    fix_starts: snap note starts, moving the notes without changing lengths
+    fix_ends: snap note ends (swung like the starts), changing the lengths
+
+    returns the new (starts, lengths) columns; a note whose end snaps onto or
+    before its start is made one grid step long
+    """
+    new_starts = starts
+    if grid and fix_starts:
+        new_starts = pull(starts, grid_lines(starts, grid, swing), strength)
+    new_starts = jitter(new_starts, humanize, seed)
+    new_starts = array('l', [max(0, start) for start in new_starts])
+    if not (grid and fix_ends):
+        return new_starts, array('l', lengths)
+    ends = array('l', [start + length for start, length in zip(starts, lengths)])
+    ends = pull(ends, grid_lines(ends, grid, swing), strength)
+    step = max(1, int(round(grid)))
+    return new_starts, array('l', [end - start if end > start else step
+        for start, end in zip(new_starts, ends)])
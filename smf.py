@@ -0,0 +1,202 @@
+"""
+Streaming Standard MIDI File import/export
+
+Import memory-maps the file and walks the track chunks one event at a time,
+yielding each note as soon as its note-off is seen, so a file is never held
+as a list of event objects. Export writes the note columns of a NoteStore
+through a small output buffer, sorted by a single key column.
+
+Times are converted to the piano roll's ticks (ticks.PPQ) on the way in and
+written at that resolution on the way out.
+"""
+import ctypes
+import mmap
+import struct
+from array import array
+
+from ticks import PPQ
+
+CHUNK = struct.Struct('>4sI')
+HEADER = struct.Struct('>HHH')
+BUFFER_SIZE = 1 << 16
+
+# -----------------------------------------------------------------------------
+# Import
+
+def iter_notes(path):
+    """yields (pitch, start, length, velocity) for every note in a .mid file,
+    times in ticks; notes from all tracks and channels are merged"""
+    with open(path, 'rb') as f:
+        ## copy-on-write only so ctypes can view it, nothing is written
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        chunks = iter_chunks(data)
+        try:
+            for note in chunks:
+                yield note
+        finally:
+            chunks.close() # releases the track views before the map closes
+            data.close()
+
+def iter_chunks(data):
+    kind, size = CHUNK.unpack_from(data, 0)
+    if kind != b'MThd' or size < HEADER.size:
+        raise ValueError('not a MIDI file')
+    format, tracks, division = HEADER.unpack_from(data, CHUNK.size)
+    if division & 0x8000:
+        raise ValueError('SMPTE time division is not supported')
+    offset = CHUNK.size + size
+    while offset + CHUNK.size <= len(data):
+        kind, size = CHUNK.unpack_from(data, offset)
+        offset += CHUNK.size
+        if kind == b'MTrk':
+            ## a view of the track in the map, not a copy; its items are ints
+            ## on python 2 and 3 alike
+            track = (ctypes.c_ubyte * min(size, len(data) - offset)).from_buffer(data, offset)
+            try:
+                for note in iter_track(track, division):
+                    yield note
+            finally:
+                del track
+        offset += size
+
+def iter_track(track, division):
+    """notes of one MTrk chunk, in note-off order"""
+    held = {} # (channel, pitch) -> [(start, velocity), ...] in note-on order
+    end = len(track)
+    i = 0
+    tick = 0
+    status = 0
+    scale = PPQ != division
+    while i < end:
+        ## delta time
+        delta = 0
+        byte = 0x80
+        while byte & 0x80:
+            byte = track[i]
+            i += 1
+            delta = (delta << 7) | (byte & 0x7f)
+        tick += delta
+        byte = track[i]
+        if byte & 0x80:
+            status = byte
+            i += 1
+        kind = status & 0xf0
+        if kind == 0x90 or kind == 0x80:
+            pitch = track[i]
+            velocity = track[i + 1]
+            i += 2
+            key = (status & 0x0f, pitch)
+            if kind == 0x90 and velocity:
+                held.setdefault(key, []).append((tick, velocity))
+                continue
+            starts = held.get(key)
+            if starts:
+                start, velocity = starts.pop(0)
+                if scale:
+                    yield (pitch, to_ticks(start, division),
+                            to_ticks(tick, division) - to_ticks(start, division), velocity)
+                else:
+                    yield (pitch, start, tick - start, velocity)
+        elif kind == 0xc0 or kind == 0xd0:
+            i += 1
+        elif kind != 0xf0:
+            i += 2
+        elif status == 0xff:
+            i += 1 # meta type
+            i, size = read_varlen(track, i)
+            i += size
+            status = 0
+        else: # sysex
+            i, size = read_varlen(track, i)
+            i += size
+            status = 0
+    ## notes still held at the end of the track end there
+    for (channel, pitch), starts in held.items():
+        for start, velocity in starts:
+            yield (pitch, to_ticks(start, division),
+                    to_ticks(tick, division) - to_ticks(start, division), velocity)
+
+def read_varlen(data, i):
+    value = 0
+    byte = 0x80
+    while byte & 0x80:
+        byte = data[i]
+        i += 1
+        value = (value << 7) | (byte & 0x7f)
+    return i, value
+
+def to_ticks(tick, division):
+    """file ticks to PPQ ticks, rounded"""
+    return (2 * tick * PPQ + division) // (2 * division)
+
+def read_columns(path):
+    """reads a .mid file into (pitches, starts, lengths, velocities) arrays,
+    ready for NoteStore.add_many / PianoRoll.loadNotes"""
+    pitches = array('B')
+    starts = array('l')
+    lengths = array('l')
+    velocities = array('B')
+    for pitch, start, length, velocity in iter_notes(path):
+        pitches.append(pitch)
+        starts.append(start)
+        lengths.append(length)
+        velocities.append(velocity)
+    return pitches, starts, lengths, velocities
+
+# -----------------------------------------------------------------------------
+# Export
+
+def write_notes(path, store, time_sig=(4, 4), tempo=120., channel=0):
+    """writes the notes of a NoteStore as a format 0 .mid file"""
+    with open(path, 'wb') as f:
+        f.write(CHUNK.pack(b'MThd', HEADER.size) + HEADER.pack(0, 1, PPQ))
+        track_start = f.tell()
+        f.write(CHUNK.pack(b'MTrk', 0)) # size patched below
+        size = 0
+        out = bytearray()
+        ## tempo and time signature meta events
+        out += b'\x00\xff\x51\x03' + struct.pack('>I', int(round(60e6 / tempo)))[1:]
+        numerator, denominator = int(time_sig[0]), int(time_sig[1])
+        out += b'\x00\xff\x58\x04' + bytearray(
+                (numerator, denominator.bit_length() - 1, 24, 8))
+        ## one sort key per event: tick * 2, plus 1 for note-ons so offs go
+        ## first; the event's row and kind are recovered from its position
+        count = len(store)
+        starts = store.starts
+        lengths = store.lengths
+        pitches = store.pitches
+        velocities = store.velocities
+        keys = array('l', [start * 2 + 1 for start in starts])
+        keys.extend([start * 2 + 2 * length for start, length in zip(starts, lengths)])
+        status = 0x90 | channel # offs are written as velocity 0 note-ons
+        tick = 0
+        for event in sorted(range(2 * count), key=keys.__getitem__):
+            key = keys[event]
+            row = event % count
+            write_varlen(out, (key >> 1) - tick)
+            if status:
+                out.append(status) # meta events cancel running status, so once
+                status = 0
+            tick = key >> 1
+            out.append(pitches[row])
+            out.append(max(1, velocities[row]) if event < count else 0)
+            if len(out) >= BUFFER_SIZE:
+                f.write(out)
+                size += len(out)
+                del out[:]
+        out += b'\x00\xff\x2f\x00' # end of track
+        f.write(out)
+        size += len(out)
+        f.seek(track_start)
+        f.write(CHUNK.pack(b'MTrk', size))
+
+def write_varlen(out, value):
+    if value < 0x80:
+        out.append(value)
+        return
+    groups = [value & 0x7f]
+    value >>= 7
+    while value:
+        groups.append(0x80 | (value & 0x7f))
+        value >>= 7
+    out.extend(reversed(groups))
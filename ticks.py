@@ -0,0 +1,35 @@
+"""
+Integer tick timebase shared by the piano roll and the transport
+
+Note positions are whole ticks at PPQ ticks per quarter note. Laying out a
+batch of notes converts their tick columns to scene x coordinates in one
+pass, and grids are exact fractions so tuplet quantization never drifts.
+"""
+from array import array
+from fractions import Fraction
+
+PPQ = 1920 # ticks per quarter note, as used by genTransport
+WHOLE_NOTE = 4 * PPQ
+
+def grid_ticks(value):
+    """exact grid step in ticks for a note value given as a fraction of a whole
+    note ('1/8', '1/9', 0.25, ...), None or 0 meaning no grid"""
+    if not value:
+        return None
+    if not isinstance(value, Fraction):
+        value = Fraction(value).limit_denominator(1000) \
+                if isinstance(value, float) else Fraction(value)
+    return value * WHOLE_NOTE
+
+def snap_tick(tick, grid):
+    """nearest grid line to a tick; lines sit at round(k * grid) so they never
+    accumulate rounding error, even for grids that are not whole ticks"""
+    if not grid:
+        return tick
+    num, den = grid.numerator, grid.denominator
+    k = (2 * tick * den + num) // (2 * num)
+    return (2 * k * num + den) // (2 * den)
+
+def ticks_to_px(ticks, px_per_tick, origin=0.):
+    """scene x coordinates (or widths, with origin 0) for a column of ticks"""
+    return array('d', [origin + tick * px_per_tick for tick in ticks])
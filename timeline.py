@@ -2,6 +2,7 @@
 A viewer for all audio items in the song.
 """
 import sys
+from array import array
 from PyQt4 import QtGui, QtCore
 colors = [QtCore.Qt.blue,
  QtCore.Qt.green,
@@ -128,6 +129,22 @@ class timeline(QtGui.QGraphicsView):
         self.scene.addItem(f_audio_item)
         self.track += 1
 
+    def save_project(self, a_project):
+        """puts the items in a project.Project"""
+        a_project.set('timeline.starts', array('d', [f_item.pos().x() for f_item in self.audio_items]))
+        a_project.set('timeline.lengths', array('d', [f_item.rect().width() for f_item in self.audio_items]))
+        a_project.set('timeline.tracks', array('i', [f_item.track_num for f_item in self.audio_items]))
+        a_project.set_text('timeline.names', [unicode(f_item.label.text()) for f_item in self.audio_items])
+
+    def load_project(self, a_project):
+        if 'timeline.starts' not in a_project:
+            return
+        self.clear_drawn_items()
+        for f_start, f_length, f_track_num, f_name in zip(a_project.get('timeline.starts'),
+                a_project.get('timeline.lengths'), a_project.get('timeline.tracks'),
+                a_project.get_text('timeline.names')):
+            self.draw_item(f_start, f_length, f_name, f_track_num)
+
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
     view = timeline(total_tracks=5)
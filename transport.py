@@ -0,0 +1,54 @@
+"""
+Thread-safe transport position mailbox
+
+The host (audio thread, OSC callback, ...) posts positions at whatever rate
+it runs at; the GUI takes the latest one once per display frame. Positions
+posted in between are coalesced instead of queued, so a fast host can never
+back up the GUI thread.
+"""
+import threading
+
+class Transport(object):
+    '''latest-value mailbox for the play position, with update counters'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = None
+        self.position = None # last position taken by the GUI
+        self.posted = 0 # updates received
+        self.coalesced = 0 # updates replaced by a newer one before a frame
+        self.dropped = 0 # frames taken that didn't move the play head
+        self.delivered = 0 # frames that repainted the play head
+
+    def post(self, position):
+        """stores a position, callable from any thread"""
+        with self.lock:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = position
+            self.posted += 1
+
+    def take(self):
+        """the newest posted position since the last take, or None"""
+        with self.lock:
+            position, self.pending = self.pending, None
+        if position is not None:
+            self.position = position
+        return position
+
+    def drop(self):
+        self.dropped += 1
+
+    def deliver(self):
+        self.delivered += 1
+
+    def stats(self):
+        return {
+            'posted': self.posted,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'delivered': self.delivered,
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.posted = self.coalesced = self.dropped = self.delivered = 0